@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    benchmark of the card templates against building a dict and json.dumps
+
+    python -m lark.bench_card
+"""
+import datetime
+import json
+import timeit
+
+import lark.card as card
+
+TEXT = "A streamed answer that keeps growing with every chunk of tokens. " * 20
+
+
+def answer_dict(content, fresh=False):
+    answer_card = {
+        "config": {"wide_screen_mode": True},
+        "elements": [
+            {"tag": "div", "text": {"tag": "lark_md", "content": content}},
+        ]
+    }
+    if fresh:
+        answer_card["elements"].extend([
+            {"tag": "hr"},
+            {"tag": "div", "text": {"tag": "lark_md", "content": "<font color='green'>Loading...</font>"}},
+        ])
+    return answer_card
+
+
+def work_order_show_dict(chats_name, user_id, assist_id, description):
+    localtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        "config": {"wide_screen_mode": True},
+        "header": {"template": "turquoise", "title": {"content": f"🚨 {chats_name}", "tag": "plain_text"}},
+        "elements": [
+            {
+                "tag": "div",
+                "fields": [
+                    {"is_short": False,
+                     "text": {"tag": "lark_md", "content": f"🕗︎ **Create      : **{localtime}"}},
+                    {"is_short": False,
+                     "text": {"tag": "lark_md", "content": f"🗣 **Applicant   : **<at id={user_id}></at>"}},
+                    {"is_short": False,
+                     "text": {"tag": "lark_md", "content": f"👨‍🔧 **Operator    : **<at id={assist_id}></at>"}},
+                ]
+            },
+            {"tag": "hr"},
+            {"tag": "div", "text": {"tag": "lark_md", "content": f"🔖 **Description : **{description}"}}
+        ]
+    }
+
+
+def markdown_dict(content):
+    return {
+        "config": {"wide_screen_mode": True},
+        "elements": [{"tag": "div", "text": {"tag": "lark_md", "content": content}}]
+    }
+
+
+def bench(name: str, old, new, number: int = 20000):
+    t_old = min(timeit.repeat(old, number=number, repeat=5)) / number * 1e6
+    t_new = min(timeit.repeat(new, number=number, repeat=5)) / number * 1e6
+    print(f"{name:16} dict+dumps: {t_old:7.2f} us   template: {t_new:7.2f} us   x{t_old / t_new:.1f}")
+
+
+if __name__ == '__main__':
+    args = ("⌛️Process-Order-20240101000000", "user_id", "assist_id", "bug_platform")
+    bench("answer", lambda: json.dumps(answer_dict(TEXT, fresh=True)), lambda: card.answer(TEXT, fresh=True))
+    bench("work_order_show", lambda: json.dumps(work_order_show_dict(*args)), lambda: card.work_order_show(*args))
+    msg = "<at id=user_id></at> The work order has been completed."
+    bench("markdown", lambda: json.dumps(markdown_dict(msg)), lambda: card.markdown(msg))
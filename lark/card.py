@@ -3,14 +3,41 @@
 """
     lark.card
 """
-from typing import List
-from lark_oapi.api.im.v1 import ListChat
+import json
+import re
+from functools import lru_cache
+from typing import Sequence, Tuple
 import datetime
 
 
+class CardTemplate:
+    """
+    A card serialized to JSON once. Fields are written as "${name}" inside
+    string values and spliced in by render(), JSON-escaped, so sending a
+    card costs a string join instead of building and dumping a dict.
+    """
+    FIELD = re.compile(r"\$\{(\w+)}")
+
+    def __init__(self, card: dict):
+        self.parts = self.FIELD.split(json.dumps(card, ensure_ascii=False))
+
+    def render(self, **fields) -> str:
+        """
+        Returns:
+            str: The card JSON, ready to be sent as message content.
+        """
+        parts = self.parts.copy()
+        for i in range(1, len(parts), 2):
+            parts[i] = json.dumps(str(fields[parts[i]]), ensure_ascii=False)[1:-1]
+        return "".join(parts)
+
+
 def hello():
     """Generate a welcome card for the robot in the group"""
-    return {
+    return _HELLO
+
+
+_HELLO = json.dumps({
         "config": {"wide_screen_mode": True},
         "header": {
             "template": "green",
@@ -35,24 +62,27 @@ def hello():
                 ]
             }
         ]
-    }
+    }, ensure_ascii=False)
+
+
+_MARKDOWN = CardTemplate({
+    "config": {
+        "wide_screen_mode": True
+    },
+    "elements": [
+        {
+            "tag": "div",
+            "text": {"tag": "lark_md", "content": "${content}"}
+        }
+    ]
+})
 
 
 def markdown(content):
-    return {
-        "config": {
-            "wide_screen_mode": True
-        },
-        "elements": [
-            {
-                "tag": "div",
-                "text": {"tag": "lark_md", "content": content}
-            }
-        ]
-    }
+    return _MARKDOWN.render(content=content)
 
 
-def uid(user_id: str, open_id: str, mentions: bool) -> dict:
+def uid(user_id: str, open_id: str, mentions: bool) -> str:
     """
     Generates a dictionary containing user ID details.
 
@@ -62,101 +92,157 @@ def uid(user_id: str, open_id: str, mentions: bool) -> dict:
         mentions (bool): Title content display depends on whether to include mentions.
 
     Returns:
-        dict: A dictionary with the user ID details.
+        str: The card JSON with the user ID details.
     """
     if mentions:
         title_content = "Details of your search user ID"
     else:
         title_content = "Details of your user ID"
+    return _UID.render(title=title_content, user_id=user_id, open_id=open_id)
+
+
+_UID = CardTemplate({
+    "header": {"template": "blue", "title": {"content": "${title}", "tag": "plain_text"}},
+    "elements": [
+        {"tag": "hr"},
+        {"tag": "markdown", "content": "🆔 **USER_ID**"},
+        {"tag": "markdown", "content": "${user_id}"},
+        {"tag": "hr"},
+        {"tag": "markdown", "content": "🆔 **OPEN_ID**"},
+        {"tag": "markdown", "content": "${open_id}"}
+    ],
+})
+
+
+# Groups shown per page, and max bytes of a groups card (Lark rejects cards over 30 KB)
+GROUPS_PAGE_SIZE = 50
+GROUPS_CARD_MAX_BYTES = 28 * 1024
+
+_GROUPS_HEAD_ROW = json.dumps({
+    "tag": "column_set", "flex_mode": "none", "background_style": "indigo",
+    "columns": [
+        {
+            "tag": "column", "width": "weighted", "weight": 2, "vertical_align": "top",
+            "elements": [{"tag": "markdown", "content": "**🗳 NAME**"}]
+        },
+        {
+            "tag": "column", "width": "weighted", "weight": 3, "vertical_align": "top",
+            "elements": [{"tag": "markdown", "content": "**🆔 ID**"}]
+        }
+    ]
+}, ensure_ascii=False)
+
+_GROUPS_ROW = CardTemplate({
+    "tag": "column_set", "flex_mode": "none", "background_style": "grey",
+    "columns": [
+        {
+            "tag": "column", "width": "weighted", "weight": 2, "vertical_align": "top",
+            "elements": [{"tag": "markdown", "content": "${name}"}]
+        },
+        {
+            "tag": "column", "width": "weighted", "weight": 3, "vertical_align": "top",
+            "elements": [{"tag": "markdown", "content": "${chat_id}"}]
+        }
+    ]
+})
+
+_GROUPS_FOOT = CardTemplate({"tag": "note", "elements": [{"tag": "plain_text", "content": "${note}"}]})
+
+# the elements list is spliced in between
+_GROUPS_CARD = json.dumps({
+    "config": {"wide_screen_mode": True, "update_multi": True},
+    "header": {"template": "blue", "title": {"content": "Groups", "tag": "plain_text"}},
+    "elements": "${elements}",
+}, ensure_ascii=False).split('"${elements}"')
+
+
+def _page_button(text: str, group_list: Sequence[Tuple[str, str]], start: int) -> dict:
     return {
-        "header": {"template": "blue", "title": {"content": title_content, "tag": "plain_text"}},
-        "elements": [
-            {"tag": "hr"},
-            {"tag": "markdown", "content": "🆔 **USER_ID**"},
-            {"tag": "markdown", "content": user_id},
-            {"tag": "hr"},
-            {"tag": "markdown", "content": "🆔 **OPEN_ID**"},
-            {"tag": "markdown", "content": open_id}
-        ],
+        "tag": "button",
+        "text": {"tag": "plain_text", "content": text},
+        "type": "default",
+        "value": {"action": "group_page", "start": start, "cursor": group_list[start][1]},
     }
 
 
-def groups(group_list: List[ListChat]):
+def groups(group_list: Sequence[Tuple[str, str]], start: int = 0, cursor: str = None) -> str:
     """
-    Generates a group card based on the provided group list.
+    Generates one page of the group card. A page holds at most
+    GROUPS_PAGE_SIZE groups and stops early so the card stays under
+    GROUPS_CARD_MAX_BYTES; prev/next buttons carry the chat_id of the
+    first group of the neighbouring pages as a cursor, and its index in
+    case that group is gone by the time the button is clicked.
 
     Args:
-        group_list (List[ListChat]): The list of groups.
+        group_list (Sequence[Tuple[str, str]]): (name, chat_id) of every group, see robot.get_group_index.
+        start (int): Index of the first group of the page, used if cursor is not in the list.
+        cursor (str): chat_id of the first group of the page.
 
     Returns:
-        dict: The generated group card.
+        str: The generated group card.
     """
-    group_card = {
-        "config": {"wide_screen_mode": True},
-        "header": {"template": "blue", "title": {"content": "Groups", "tag": "plain_text"}},
-        "elements": [
-            {
-                "tag": "column_set", "flex_mode": "none", "background_style": "indigo",
-                "columns": [
-                    {
-                        "tag": "column", "width": "weighted", "weight": 2, "vertical_align": "top",
-                        "elements": [{"tag": "markdown", "content": "**🗳 NAME**"}]
-                    },
-                    {
-                        "tag": "column", "width": "weighted", "weight": 3, "vertical_align": "top",
-                        "elements": [{"tag": "markdown", "content": "**🆔 ID**"}]
-                    }
-                ]
-            }
-        ]
-    }
-    group: ListChat
-    for group in group_list:
-        if group.name is None:
-            group.name = ""
-        if group.chat_id is None:
-            group.chat_id = ""
-        new_fields = [
-            {
-                "tag": "column_set", "flex_mode": "none", "background_style": "grey",
-                "columns": [
-                    {
-                        "tag": "column", "width": "weighted", "weight": 2, "vertical_align": "top",
-                        "elements": [{"tag": "markdown", "content": group.name}]
-                    },
-                    {
-                        "tag": "column", "width": "weighted", "weight": 3, "vertical_align": "top",
-                        "elements": [{"tag": "markdown", "content": group.chat_id}]
-                    }
-                ]
-            }
-        ]
-        group_card["elements"].extend(new_fields)
-    return group_card
+    total = len(group_list)
+    if cursor:
+        # the list may have been refetched since the button was rendered, find the group again
+        start = next((i for i, (_, chat_id) in enumerate(group_list) if chat_id == cursor), start)
+    start = max(0, min(start, max(total - 1, 0)))
+    elements = [_GROUPS_HEAD_ROW]
+    # reserve room for the frame, the buttons and the note
+    size = len(_GROUPS_CARD[0]) + len(_GROUPS_CARD[1]) + len(_GROUPS_HEAD_ROW) + 512
+    end = start
+    for name, chat_id in group_list[start:start + GROUPS_PAGE_SIZE]:
+        row = _GROUPS_ROW.render(name=name or "", chat_id=chat_id or "")
+        row_size = len(row.encode()) + 1
+        if end > start and size + row_size > GROUPS_CARD_MAX_BYTES:
+            break
+        elements.append(row)
+        size += row_size
+        end += 1
 
+    buttons = []
+    if start > 0:
+        buttons.append(_page_button("⬅ Prev", group_list, max(0, start - GROUPS_PAGE_SIZE)))
+    if end < total:
+        buttons.append(_page_button("Next ➡", group_list, end))
+    if buttons:
+        elements.append(json.dumps({"tag": "action", "actions": buttons}, ensure_ascii=False))
+    note = f"{start + 1}-{end} of {total}" if total else "No groups"
+    elements.append(_GROUPS_FOOT.render(note=note))
+    return _GROUPS_CARD[0] + "[" + ",".join(elements) + "]" + _GROUPS_CARD[1]
 
-def answer(content, fresh=False):
-    answer_card = {
-        "config": {
-            "wide_screen_mode": True
-        },
-        "elements": [
-            {"tag": "div", "text": {"tag": "lark_md", "content": content}},
-        ]
-    }
 
-    if fresh:
-        fresh_msg = [
-            {"tag": "hr"},
-            {"tag": "div", "text": {"tag": "lark_md", "content": "<font color='green'>Loading...</font>"}},
-        ]
-        answer_card["elements"].extend(fresh_msg)
-    return answer_card
+_ANSWER = CardTemplate({
+    "config": {
+        "wide_screen_mode": True
+    },
+    "elements": [
+        {"tag": "div", "text": {"tag": "lark_md", "content": "${content}"}},
+    ]
+})
+
+_ANSWER_FRESH = CardTemplate({
+    "config": {
+        "wide_screen_mode": True
+    },
+    "elements": [
+        {"tag": "div", "text": {"tag": "lark_md", "content": "${content}"}},
+        {"tag": "hr"},
+        {"tag": "div", "text": {"tag": "lark_md", "content": "<font color='green'>Loading...</font>"}},
+    ]
+})
+
+
+def answer(content, fresh=False):
+    """ Answer card, with a loading line while the answer is still streaming """
+    return (_ANSWER_FRESH if fresh else _ANSWER).render(content=content)
 
 
 def work_order_build():
     """  build work order card """
-    return {
+    return _WORK_ORDER_BUILD
+
+
+_WORK_ORDER_BUILD = json.dumps({
         "config": {"wide_screen_mode": True},
         "header": {"template": "blue", "title": {"content": "Work Order", "tag": "plain_text"}},
         "elements": [
@@ -174,33 +260,34 @@ def work_order_build():
                 ]
             }
         ]
-    }
+    }, ensure_ascii=False)
+
+
+_WORK_ORDER_SHOW = CardTemplate({
+    "config": {"wide_screen_mode": True},
+    "header": {"template": "turquoise", "title": {"content": "🚨 ${chats_name}", "tag": "plain_text"}},
+    "elements": [
+        {
+            "tag": "div",
+            "fields": [
+                {"is_short": False, "text": {"tag": "lark_md", "content": "🕗︎ **Create      : **${localtime}"}},
+                {"is_short": False,
+                 "text": {"tag": "lark_md", "content": "🗣 **Applicant   : **<at id=${user_id}></at>"}},
+                {"is_short": False,
+                 "text": {"tag": "lark_md", "content": "👨‍🔧 **Operator    : **<at id=${assist_id}></at>"}},
+            ]
+        },
+        {"tag": "hr"},
+        {"tag": "div", "text": {"tag": "lark_md", "content": "🔖 **Description : **${description}"}}
+    ]
+})
 
 
 def work_order_show(chats_name: str, user_id: str, assist_id: str, description: str):
-    now = datetime.datetime.now()
-    localtime = now.strftime("%Y-%m-%d %H:%M:%S")
-    create_time = f"🕗︎ **Create      : **{localtime}"
-    applicant = f"🗣 **Applicant   : **<at id={user_id}></at>"
-    operator = f"👨‍🔧 **Operator    : **<at id={assist_id}></at>"
-    order_content = f"🔖 **Description : **{description}"
-    work_order_show_card = {
-        "config": {"wide_screen_mode": True},
-        "header": {"template": "turquoise", "title": {"content": f"🚨 {chats_name}", "tag": "plain_text"}},
-        "elements": [
-            {
-                "tag": "div",
-                "fields": [
-                    {"is_short": False, "text": {"tag": "lark_md", "content": create_time}},
-                    {"is_short": False, "text": {"tag": "lark_md", "content": applicant}},
-                    {"is_short": False, "text": {"tag": "lark_md", "content": operator}},
-                ]
-            },
-            {"tag": "hr"},
-            {"tag": "div", "text": {"tag": "lark_md", "content": order_content}}
-        ]
-    }
-    return work_order_show_card
+    localtime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return _WORK_ORDER_SHOW.render(
+        chats_name=chats_name, localtime=localtime, user_id=user_id, assist_id=assist_id, description=description
+    )
 
 
 WORK_ORDER_LIST = [
@@ -230,8 +317,9 @@ WORK_ORDER_LIST = [
 ]
 
 
+@lru_cache(maxsize=1)
 def work_order_select():
-    """选择工单类型"""
+    """选择工单类型, built once; callers must not modify it"""
     select_card = {
         "config": {"wide_screen_mode": True},
         "header": {"template": "blue", "title": {"content": "Choose Service", "tag": "plain_text"}},
@@ -259,8 +347,9 @@ def work_order_select():
     return select_card
 
 
+@lru_cache(maxsize=None)
 def work_order_list(work_order_type):
-    """工单类型子列表"""
+    """工单类型子列表, built once per type; callers must not modify it"""
     list_card = {
         "config": {"wide_screen_mode": True},
         "header": {"template": "blue", "title": {"content": "Choose Service", "tag": "plain_text"}},
@@ -295,28 +384,31 @@ def work_order_list(work_order_type):
     return list_card
 
 
-def work_order_how(operator):
-    return {
-        "config": {
-            "wide_screen_mode": True
-        },
-        "elements": [
-            {
-                "extra": {
-                    "tag": "button",
-                    "text": {
-                        "content": "🙋 DONE",
-                        "tag": "lark_md"
-                    },
-                    "type": "primary",
-                    "value": {
-                        "action": "done"
-                    }
-                },
-                "tag": "div",
+_WORK_ORDER_HOW = CardTemplate({
+    "config": {
+        "wide_screen_mode": True
+    },
+    "elements": [
+        {
+            "extra": {
+                "tag": "button",
                 "text": {
-                    "content": f"<at id={operator}></at>What's going on now? 😛 If done please click  👉",
-                    "tag": "lark_md"},
+                    "content": "🙋 DONE",
+                    "tag": "lark_md"
+                },
+                "type": "primary",
+                "value": {
+                    "action": "done"
+                }
             },
-        ]
-    }
+            "tag": "div",
+            "text": {
+                "content": "<at id=${operator}></at>What's going on now? 😛 If done please click  👉",
+                "tag": "lark_md"},
+        },
+    ]
+})
+
+
+def work_order_how(operator):
+    return _WORK_ORDER_HOW.render(operator=operator)
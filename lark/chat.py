@@ -3,14 +3,35 @@
 """
     This is a sample chat api for lark
 """
-import time
-from openai import OpenAI
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
 
 import utils.config as config
+import utils.openai_pool as openai_pool
+import utils.completion_cache as completion_cache
 import utils.robot as robot
+from utils.patcher import CardPatcher
 import lark.card as card
 from lark_oapi import logger
 import store.db_chat_p2p as db_chat_p2p
+import utils.tokens as tokens
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = "You are a helpful assistant."
+# Tokens of prompt, history and new message sent per request, leaving room for the answer
+HISTORY_TOKEN_BUDGET = 3000
+
+_completion_cache = completion_cache.CompletionCache(persistent=config.app_config().CHAT_CACHE_PERSISTENT)
+
+SUMMARY_MAP_PROMPT = "Please summarize the following part of a dialog in markdown format. Keep names and decisions."
+SUMMARY_REDUCE_PROMPT = "Please merge the following partial summaries of one dialog into one markdown summary."
+# Tokens of dialog per summarized chunk, and chunk summaries requested at once
+SUMMARY_CHUNK_TOKENS = 2000
+SUMMARY_CONCURRENCY = 4
+
+# Chunk summaries are always cached, they are reused when a chat is summarized again
+_summary_cache = completion_cache.CompletionCache(persistent=config.app_config().CHAT_CACHE_PERSISTENT)
 
 
 def clear_chat_p2p(user_id: str):
@@ -24,6 +45,7 @@ def clear_chat_p2p(user_id: str):
     )
     if db_chat_p2p.select_chat_p2p_by_user_id(user_id) is not None:
         db_chat_p2p.clear_chat_p2p_by_user_id(user_id)
+    db_chat_p2p.clear_chat_message_by_user_id(user_id)
 
     db_chat_p2p.insert_chat_p2p(new_data)
 
@@ -43,14 +65,11 @@ def set_chat_model(user_id: str, model: str):
 
 
 def get_completion_from_messages(messages,
-                                 model="gpt-3.5-turbo",
+                                 model=DEFAULT_MODEL,
                                  temperature=0,
                                  max_tokens=500,
                                  stream=False):
-    client = OpenAI(
-        api_key=config.app_config().CHAT_KEY,
-    )
-    response = client.chat.completions.create(
+    response = openai_pool.get_pool().create(
         model=model,
         messages=messages,
         temperature=temperature,
@@ -60,46 +79,159 @@ def get_completion_from_messages(messages,
     return response
 
 
+def build_messages(prompt: str, user_id: str, context: str) -> list:
+    """
+    Builds the request messages: system prompt, user prompt, as much of the
+    user's recent history as fits HISTORY_TOKEN_BUDGET, then the new message.
+    """
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+    if prompt:
+        messages.append({"role": "system", "content": prompt})
+    budget = HISTORY_TOKEN_BUDGET - sum(tokens.count_message_tokens(m["content"]) for m in messages) \
+        - tokens.count_message_tokens(context)
+    if budget > 0:
+        for message in db_chat_p2p.select_chat_message_window(user_id, budget):
+            messages.append({"role": message.role, "content": message.content})
+    messages.append({"role": "user", "content": context})
+    return messages
+
+
+def save_turn(user_id: str, context: str, answer: str):
+    db_chat_p2p.insert_chat_messages(user_id, [
+        ("user", context, tokens.count_message_tokens(context)),
+        ("assistant", answer, tokens.count_message_tokens(answer)),
+    ])
+
+
 def get_gpt3_response(user_id: str, message_id: str, context):
-    card_send = robot.reply_card(message_id, card.answer("Waiting a moment...", fresh=True))
-    card_id = card_send.message_id
     data = db_chat_p2p.select_chat_p2p_by_user_id(user_id)
-    if data is not None:
-        prompt = data.prompts
-        history_context = data.content
-        context = prompt + history_context + context
-    else:
+    if data is None:
         msg = "sorry,no chat p2p data"
         logger.error(msg)
-        robot.refresh_card(card_id, card.answer(msg, fresh=False))
+        robot.reply_card(message_id, card.answer(msg, fresh=False))
         return
-    messages = [
-        {"role": "system", "content": "You are a helpful assistant."},
-        {"role": "user", "content": context},
-    ]
+    messages = build_messages(data.prompts, user_id, context)
+
+    key = None
+    if config.app_config().CHAT_CACHE:
+        # keyed on the question alone, not the user's history, so one user's answer serves everyone
+        system = [m for m in messages if m["role"] == "system"]
+        key = completion_cache.cache_key(DEFAULT_MODEL, system + messages[-1:])
+        answer = _completion_cache.get(key)
+        if answer is not None:
+            robot.reply_card(message_id, card.answer(answer, fresh=False))
+            save_turn(user_id, context, answer)
+            return
+
+    card_send = robot.reply_card(message_id, card.answer("Waiting a moment...", fresh=True))
+    card_id = card_send.message_id
     stream_messages = ""
-    start_time = time.time()
-    stream = get_completion_from_messages(messages, stream=True)
-    for chunk in stream:
-        if chunk.choices[0].delta.content is not None:
-            stream_message = chunk.choices[0].delta.content
-            stream_messages += stream_message
-        current_time = time.time()
-        if current_time - start_time > 0.7:
-            robot.refresh_card(card_id, card.answer(stream_messages, fresh=True))
-            start_time = current_time
-
-    robot.refresh_card(card_id, card.answer(stream_messages, fresh=False))
-
-
-def summary(chat_id: str, context):
-    sys_content = "Please summarize the following dialog and return the summary in markdown format."
+    patcher = CardPatcher(card_id, lambda text: card.answer(text, fresh=True))
+    try:
+        stream = get_completion_from_messages(messages, model=DEFAULT_MODEL, stream=True)
+        for chunk in stream:
+            if chunk.choices[0].delta.content is not None:
+                stream_messages += chunk.choices[0].delta.content
+                patcher.update(stream_messages)
+    finally:
+        final = card.answer(stream_messages, fresh=False)
+        if not patcher.close(final):
+            # the card would stay on its last streamed state, send the answer as a new reply
+            logger.error(f"answer card {card_id} not finalized, replying instead")
+            robot.reply_card(message_id, final)
+
+    if stream_messages:
+        save_turn(user_id, context, stream_messages)
+        # only an answer given without history is known not to depend on it
+        if key is not None and len(messages) == len(system) + 1:
+            _completion_cache.set(key, stream_messages)
+
+
+def stats() -> dict:
+    return {"completion_cache": _completion_cache.stats(), "summary_cache": _summary_cache.stats()}
+
+
+def _complete_cached(system: str, text: str) -> str:
+    """ One non-streaming completion, served from the summary cache when possible """
     messages = [
-        {"role": "system", "content": sys_content},
-        {"role": "user", "content": context},
+        {"role": "system", "content": system},
+        {"role": "user", "content": text},
     ]
-    response = get_completion_from_messages(messages)
-    robot.send_card("chat_id", chat_id, card.markdown(response.choices[0].message.content))
+    key = completion_cache.cache_key(DEFAULT_MODEL, messages)
+    answer = _summary_cache.get(key)
+    if answer is None:
+        answer = get_completion_from_messages(messages).choices[0].message.content or ""
+        _summary_cache.set(key, answer)
+    return answer
+
+
+def _chunk_lines(lines: Iterable[str], chunk_tokens: int) -> Iterator[str]:
+    """
+    Groups lines into chunks of at most chunk_tokens tokens. Boundaries only
+    depend on the lines before them, so the chunks of an old part of a chat
+    stay the same as it grows, and their summaries are cache hits.
+    """
+    chunk, size = [], 0
+    for line in lines:
+        line_tokens = tokens.count_tokens(line)
+        if chunk and size + line_tokens > chunk_tokens:
+            yield "\n".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += line_tokens
+    if chunk:
+        yield "\n".join(chunk)
+
+
+def _history_lines(chat_id: str) -> Iterator[str]:
+    """ The text messages of a chat as "sender: text" lines, pulled page by page """
+    for message in robot.iter_chat_history(chat_id):
+        if message.msg_type != "text" or message.body is None or message.deleted:
+            continue
+        text = json.loads(message.body.content).get("text", "").strip()
+        if text:
+            sender = message.sender.id if message.sender is not None else ""
+            yield f"{sender}: {text}"
+
+
+def summarize(lines: Iterable[str]) -> str:
+    """
+    Map-reduce summary of a long dialog: chunks are summarized concurrently
+    as they are read, then the summaries are merged level by level until one
+    is left. Chunk and merge results are cached, so summarizing a chat again
+    only calls the model for its new tail.
+    """
+    with ThreadPoolExecutor(SUMMARY_CONCURRENCY, thread_name_prefix="summary") as pool:
+        futures = [pool.submit(_complete_cached, SUMMARY_MAP_PROMPT, chunk)
+                   for chunk in _chunk_lines(lines, SUMMARY_CHUNK_TOKENS)]
+        summaries = [f.result() for f in futures]
+        while len(summaries) > 1:
+            groups = list(_chunk_lines(summaries, SUMMARY_CHUNK_TOKENS))
+            if len(groups) == len(summaries):
+                # every summary fills a chunk on its own, merge pairwise
+                groups = ["\n".join(summaries[i:i + 2]) for i in range(0, len(summaries), 2)]
+            summaries = list(pool.map(lambda group: _complete_cached(SUMMARY_REDUCE_PROMPT, group), groups))
+    return summaries[0] if summaries else ""
+
+
+def summary(chat_id: str, context: str = None):
+    """
+    Summarize a dialog and send it to the chat as a markdown card.
+
+    Args:
+        chat_id (str): The chat to send the summary to.
+        context (str): The dialog; the chat history of chat_id if None.
+    """
+    lines = _history_lines(chat_id) if context is None else context.splitlines()
+    try:
+        result = summarize(lines)
+    except robot.PageError as e:
+        # a summary of part of the history would read as complete
+        logger.error(f"summary of {chat_id} failed: {e}")
+        result = "Could not read the chat history, please try again later."
+    if not result:
+        result = "Nothing to summarize."
+    robot.send_card("chat_id", chat_id, card.markdown(result))
 
 
 if __name__ == '__main__':
@@ -3,28 +3,35 @@
 """
     This is a command parser.
 """
+import logging
 import re
 from abc import abstractmethod, ABC
-from typing import List
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Type
 
 import lark_oapi as lark
-from lark_oapi import logger
-from lark_oapi.api.im.v1 import P2ImMessageReceiveV1Data, ListChat
+from lark_oapi.api.im.v1 import P2ImMessageReceiveV1Data
 
 import utils.robot as robot
+import utils.lanes as lanes
+import utils.log as log
 import lark.card as card
 import lark.chat as chat
 import lark.work_order as order
-from utils.config import app_config
+import lark.group as group
+from utils.config import app_config, add_reload_hook
 
 
 class BaseCommand(ABC):
-    def __init__(self, event: P2ImMessageReceiveV1Data, cmd_args: List[str]):
+    def __init__(self, event: P2ImMessageReceiveV1Data, cmd_args: List[str], text: str = None):
         self.event = event
         self.message = event.message
         self.chat_type = self.message.chat_type
-        self.content = lark.json.loads(self.message.content)
-        self.text = self.content['text']
+        if text is None:
+            text = lark.json.loads(self.message.content)['text']
+        self.text = text
         self.mentions = self.message.mentions
         self.sender = self.event.sender
         self.args = cmd_args
@@ -45,25 +52,32 @@ class IDCommandP2P(BaseCommand):
 class GroupCommand(BaseCommand):
     def execute(self) -> None:
         if len(self.args) < 1:
-            robot.reply_text(self.message.message_id, "group list/delete")
+            robot.reply_text(self.message.message_id, "group list/delete/prune")
             return
         sub_command = self.args[0]
+        try:
+            self._execute(sub_command)
+        except robot.PageError:
+            # a partial group list would be shown, or pruned, as if complete
+            robot.reply_text(self.message.message_id, "Could not list the groups, please try again later.")
+
+    def _execute(self, sub_command: str) -> None:
         if sub_command == "list":
-            group_list: List[ListChat] = robot.get_group_list()
-            robot.reply_card(self.message.message_id, card.groups(group_list))
+            robot.reply_card(self.message.message_id, card.groups(robot.get_group_index()))
             return
         if sub_command == "delete":
             if len(self.args) < 2:
                 robot.reply_text(self.message.message_id, "group delete <group_id>")
                 return
-            chat_ids = self.args[1:]
-            ret_msg = ""
-            for chat_id in chat_ids:
-                if not robot.delete_group(chat_id):
-                    ret_msg += f"delete group {chat_id} failed\n"
-                else:
-                    ret_msg += f"delete group {chat_id} success\n"
-            robot.reply_text(self.message.message_id, ret_msg)
+            group.bulk_delete(self.message.message_id, self.args[1:])
+            return
+        if sub_command == "prune":
+            if len(self.args) < 2 or (len(self.args) > 2 and not self.args[2].isdigit()):
+                robot.reply_text(self.message.message_id, "group prune <name_pattern> [older_than_days]")
+                return
+            days = int(self.args[2]) if len(self.args) > 2 else 0
+            matched = group.match_groups(self.args[1], days)
+            group.bulk_delete(self.message.message_id, [chat_id for _, chat_id in matched])
             return
 
 
@@ -123,7 +137,8 @@ COMMAND_P2P = [
     },
     {
         "command": "group",
-        "usage": "group list: display group list\n\tgroup delete <group_id1 group_id2 ...>: delete group[s]",
+        "usage": "group list: display group list\n\tgroup delete <group_id1 group_id2 ...>: delete group[s]"
+                 "\n\tgroup prune <name_pattern> [older_than_days]: delete matching groups, e.g. Done-Order-* 7",
         "handler": GroupCommand,
     },
     {
@@ -167,20 +182,19 @@ COMMAND_GROUP = [
 ]
 
 
+COMMAND_P2P_TABLE = {c['command']: c['handler'] for c in COMMAND_P2P}
+COMMAND_GROUP_TABLE = {c['command']: c['handler'] for c in COMMAND_GROUP}
+
+
 def get_command_class_p2p(command: str):
-    for p2p in COMMAND_P2P:
-        if p2p['command'] == command:
-            return p2p['handler']
-    return None
+    return COMMAND_P2P_TABLE.get(command)
 
 
 def get_command_class_group(command):
-    for group in COMMAND_GROUP:
-        if group['command'] == command:
-            return group['handler']
-    return None
+    return COMMAND_GROUP_TABLE.get(command)
 
 
+@lru_cache(maxsize=None)
 def usage(chat_type: str):
     display_usage = ""
     if chat_type == 'p2p':
@@ -189,50 +203,126 @@ def usage(chat_type: str):
             display_usage += f"\t{p2p['usage']}\n"
     if chat_type == 'group':
         display_usage = "Usage:\n"
-        for group in COMMAND_GROUP:
-            display_usage += f"\t{group['usage']}\n"
+        for entry in COMMAND_GROUP:
+            display_usage += f"\t{entry['usage']}\n"
     return display_usage
 
 
-def parse_command(chat_type: str, text: str):
-    if chat_type == 'p2p':
-        return text.split()[0]
-    if chat_type == 'group':
-        return text.split()[1]
+@dataclass(frozen=True)
+class Dispatch:
+    """ A text message parsed once: its command handler, args and work lane """
+    event: P2ImMessageReceiveV1Data
+    text: str
+    command: str
+    args: List[str]
+    cmd_class: Optional[Type[BaseCommand]]
+    lane: str
+
+
+class Dispatcher:
+    def __init__(self, robot_name: str):
+        self.mention = re.compile(robot_name)
+        # why messages were dropped before reaching a lane
+        self.dropped = Counter()
+
+    def for_robot(self, event: P2ImMessageReceiveV1Data) -> bool:
+        """
+        A group message is for the robot if its first mention is the robot:
+        matched by open ID when the robot's is already cached, else by ROBOT_NAME.
+        """
+        mentions = event.message.mentions
+        if not mentions:
+            return False
+        first = mentions[0]
+        bot_open_id = robot.cached_bot_open_id()
+        if bot_open_id and first.id is not None and first.id.open_id:
+            return first.id.open_id == bot_open_id
+        return first.name is not None and self.mention.search(first.name) is not None
+
+    def _drop(self, reason: str) -> None:
+        self.dropped[reason] += 1
+        return None
+
+    def parse(self, event: P2ImMessageReceiveV1Data) -> Optional[Dispatch]:
+        """
+        Filters messages that are not for the robot, then tokenizes the
+        message once and looks up its command. Group messages are filtered
+        on chat type and mentions before the content is even decoded.
+
+        Returns:
+            Optional[Dispatch]: The dispatch, or None if there is nothing to run.
+        """
+        message = event.message
+        chat_type = message.chat_type
+        if message.message_type != 'text':
+            return self._drop('not_text')
+        if chat_type == 'group' and not self.for_robot(event):
+            return self._drop('not_for_robot')
+        if chat_type not in ('p2p', 'group'):
+            return self._drop('chat_type')
+
+        text = lark.json.loads(message.content).get('text', '')
+        words = text.split()
+        if chat_type == 'p2p':
+            if not words:
+                return self._drop('empty')
+            command, args = words[0], words[1:]
+            if command == 'help':
+                return Dispatch(event, text, command, args, None, lanes.FAST)
+            cmd_class = COMMAND_P2P_TABLE.get(command)
+            if cmd_class is None:
+                return Dispatch(event, text, command, args, OtherCommand, lanes.CHAT)
+            return Dispatch(event, text, command, args, cmd_class, lanes.FAST)
+
+        # the first word is the robot mention, a bare mention asks for help
+        command, args = (words[1], words[2:]) if len(words) > 1 else ('help', [])
+        if command == 'help':
+            return Dispatch(event, text, command, args, None, lanes.FAST)
+        cmd_class = COMMAND_GROUP_TABLE.get(command)
+        if cmd_class is None:
+            return self._drop('unknown_command')
+        lane = lanes.ORDER if cmd_class in (DoneCommand, OperatorCommand) else lanes.FAST
+        return Dispatch(event, text, command, args, cmd_class, lane)
 
 
-def parse_args(chat_type: str, text: str):
-    if chat_type == 'p2p':
-        return text.split()[1:]
-    if chat_type == 'group':
-        return text.split()[2:]
+_dispatcher = Dispatcher(app_config().ROBOT_NAME)
 
 
-def handle_text(event: P2ImMessageReceiveV1Data):
-    content = lark.json.loads(event.message.content)
-    text = content['text']
-    chat_type = event.message.chat_type
-    command = parse_command(chat_type, text)
-    if command == 'help':
-        robot.reply_text(event.message.message_id, usage(chat_type))
+def _on_config_reload(config):
+    global _dispatcher
+    if _dispatcher.mention.pattern != config.ROBOT_NAME:
+        dropped = _dispatcher.dropped
+        _dispatcher = Dispatcher(config.ROBOT_NAME)
+        _dispatcher.dropped = dropped
+
+
+add_reload_hook(_on_config_reload)
+
+
+def dispatch(event: P2ImMessageReceiveV1Data) -> Optional[Dispatch]:
+    """ Parse a text message with the current dispatcher, see Dispatcher.parse """
+    return _dispatcher.parse(event)
+
+
+def stats() -> dict:
+    """ Messages dropped before dispatch, by reason """
+    return dict(_dispatcher.dropped)
+
+
+def run(d: Dispatch):
+    """ Execute a parsed message """
+    if d.cmd_class is None:
+        robot.reply_text(d.event.message.message_id, usage(d.event.message.chat_type))
         return
-    args = parse_args(chat_type, text)
-    if event.message.chat_type == 'p2p':
-        cmd_class = get_command_class_p2p(command)
-        if cmd_class is None:
-            cmd_class = OtherCommand
-    else:
-        pattern = re.compile(app_config().ROBOT_NAME)
-        mentions = event.message.mentions
-        if mentions is None or re.search(pattern, mentions[0].name) is None:
-            logger.error(f"this message not for robot: {event.message.content}")
-            return
-        cmd_class = get_command_class_group(command)
-        if cmd_class is None:
-            return
-    cmd = cmd_class(event, args)
+    d.cmd_class(d.event, d.args, d.text).execute()
 
-    cmd.execute()
+
+def handle_text(event: P2ImMessageReceiveV1Data):
+    d = dispatch(event)
+    if d is None:
+        log.sampled("not_for_robot", logging.DEBUG, "this message not for robot: %s", event.message.message_id)
+        return
+    run(d)
 
 
 if __name__ == '__main__':
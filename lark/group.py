@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    lark.group
+"""
+import asyncio
+import datetime
+import fnmatch
+import re
+from typing import List, Optional, Tuple
+
+import lark.card as card
+import utils.arobot as arobot
+import utils.robot as robot
+from utils.patcher import CardPatcher
+import store.db_order as db_order
+
+# Group deletions per second and in flight at once
+DELETE_RATE = 10
+DELETE_CONCURRENCY = 5
+# Max bytes of failed group ids listed in the delete card, Lark rejects cards over 30 KB
+DELETE_REPORT_MAX_BYTES = 16 * 1024
+
+# Work order group names end with their creation time, e.g. Done-Order-20240101093000
+_NAME_TIME = re.compile(r"(\d{14})$")
+
+
+def group_created(name: str, chat_id: str) -> Optional[datetime.datetime]:
+    """
+    Creation time of a group: the timestamp in a work order group name,
+    else the create time of its work order, else None.
+    """
+    found = _NAME_TIME.search(name)
+    if found:
+        try:
+            return datetime.datetime.strptime(found.group(1), "%Y%m%d%H%M%S")
+        except ValueError:
+            pass
+    data = db_order.select_work_order_by_chat_id(chat_id)
+    return data.create_time if data is not None else None
+
+
+def match_groups(pattern: str, older_than_days: int = 0) -> List[Tuple[str, str]]:
+    """
+    Groups whose name matches a shell-style pattern, e.g. Done-Order-*
+
+    Args:
+        pattern (str): The name pattern.
+        older_than_days (int): Only groups created more than this many days ago, if > 0.
+
+    Returns:
+        List[Tuple[str, str]]: (name, chat_id) of the matching groups.
+    """
+    deadline = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+    matched = []
+    for name, chat_id in robot.get_group_index():
+        if not fnmatch.fnmatchcase(name, pattern):
+            continue
+        if older_than_days > 0:
+            created = group_created(name, chat_id)
+            if created is None or created > deadline:
+                continue
+        matched.append((name, chat_id))
+    return matched
+
+
+def patch_groups_page(message_id: str, start: int, cursor: Optional[str]):
+    """
+    Fetch the group index and patch a page of it into a groups card, for
+    a page the card callback could not serve from the cached index.
+    """
+    try:
+        content = card.groups(robot.get_group_index(), start, cursor)
+    except robot.PageError:
+        content = card.markdown("Could not list the groups, please try again later.")
+    robot.refresh_card(message_id, content)
+
+
+class _DeleteReport:
+    """
+    Running counts of a bulk delete. Failed ids are listed up to
+    DELETE_REPORT_MAX_BYTES so the card stays under Lark's 30 KB limit,
+    the rest are only counted; successes are never listed.
+    """
+
+    def __init__(self, total: int):
+        self.total = total
+        self.deleted = 0
+        self.failed = 0
+        self._listed: List[str] = []
+        self._listed_bytes = 0
+
+    def add(self, chat_id: str, ok: bool):
+        if ok:
+            self.deleted += 1
+            return
+        self.failed += 1
+        line = f"delete group {chat_id} failed"
+        if self._listed_bytes + len(line.encode()) + 1 <= DELETE_REPORT_MAX_BYTES:
+            self._listed.append(line)
+            self._listed_bytes += len(line.encode()) + 1
+
+    def _failures(self) -> str:
+        lines = list(self._listed)
+        if self.failed > len(lines):
+            lines.append(f"... and {self.failed - len(lines)} more failed")
+        return "\n".join(lines)
+
+    def progress(self) -> str:
+        done = self.deleted + self.failed
+        return f"Deleting groups {done}/{self.total}, {self.failed} failed\n" + self._failures()
+
+    def summary(self) -> str:
+        return f"Deleted {self.deleted}/{self.total} groups, {self.failed} failed\n" + self._failures()
+
+
+async def _delete_all(chat_ids: List[str], patcher: CardPatcher, report: _DeleteReport):
+    """ Delete groups concurrently, spaced to DELETE_RATE per second, reporting progress """
+    semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+
+    async def delete(i, chat_id):
+        await asyncio.sleep(i / DELETE_RATE)
+        async with semaphore:
+            try:
+                ok = await arobot.delete_group(chat_id)
+            except Exception:
+                ok = False
+        report.add(chat_id, ok)
+        patcher.update(report.progress())
+
+    await asyncio.gather(*(delete(i, c) for i, c in enumerate(chat_ids)))
+
+
+def bulk_delete(msg_id: str, chat_ids: List[str]):
+    """
+    Delete groups concurrently and stream the progress and failures into a reply card.
+
+    Args:
+        msg_id (str): The message to reply the progress card to.
+        chat_ids (List[str]): The groups to delete.
+    """
+    if not chat_ids:
+        robot.reply_card(msg_id, card.markdown("No group to delete."))
+        return
+    card_send = robot.reply_card(msg_id, card.markdown(f"Deleting groups 0/{len(chat_ids)}"))
+    if card_send is None:
+        return
+    patcher = CardPatcher(card_send.message_id, card.markdown)
+    report = _DeleteReport(len(chat_ids))
+    try:
+        arobot.call(_delete_all(chat_ids, patcher, report))
+    finally:
+        patcher.close(card.markdown(report.summary()))
+        robot.invalidate_group_index()
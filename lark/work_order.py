@@ -3,18 +3,31 @@
 """
     lark.work_order
 """
+import asyncio
 import datetime
 
 from lark_oapi import logger
 
 import lark.card as card
 import utils.robot as robot
+import utils.arobot as arobot
+import utils.combiner as combiner
 import utils.config as config
 import store.db_order as db_order
 
 from typing import List
 
-DEFAULT_DEADLINE = datetime.datetime.now() + datetime.timedelta(minutes=2)
+DEADLINE_DELTA = datetime.timedelta(minutes=2)
+
+# Overdue orders read and updated per transaction
+CHECK_CHUNK = 500
+# Reminder cards sent per second and in flight at once
+REMIND_RATE = 40
+REMIND_CONCURRENCY = 20
+
+
+def next_deadline() -> datetime.datetime:
+    return datetime.datetime.now() + DEADLINE_DELTA
 
 
 def reply(msg_id: str):
@@ -40,26 +53,57 @@ def build(user_id: str, description: str):
     new_order.status = False
     new_order.classify = "Work Order"
     new_order.description = description
-    new_order.deadline = DEFAULT_DEADLINE
+    new_order.deadline = next_deadline()
 
     db_order.insert_work_order(new_order)
 
 
-def check():
+async def _remind(orders) -> list:
+    """ Send the reminder cards of one chunk concurrently, spaced to REMIND_RATE per second """
+    semaphore = asyncio.Semaphore(REMIND_CONCURRENCY)
+    coalesce = config.app_config().SEND_COALESCE_MS > 0
+
+    async def send(i, work_order):
+        await asyncio.sleep(i / REMIND_RATE)
+        content = card.work_order_how(work_order.operator)
+        async with semaphore:
+            if coalesce:
+                return await asyncio.wrap_future(combiner.send_card("chat_id", work_order.chat_id, content))
+            return await arobot.send_card("chat_id", work_order.chat_id, content)
+
+    return await asyncio.gather(*(send(i, o) for i, o in enumerate(orders)), return_exceptions=True)
+
+
+def check() -> dict:
     """
     Check the work orders and update their deadlines if necessary.
+    Overdue orders are handled in chunks: one bulk deadline update per chunk,
+    then the reminder cards of the chunk are sent concurrently.
+
+    Returns:
+        dict: The number of orders processed, reminders sent and failed.
     """
-    data = db_order.select_work_order_by_status_time(False)
-    if not data:
+    result = {"processed": 0, "sent": 0, "failed": 0}
+    after_id = 0
+    while True:
+        data = db_order.select_work_order_by_status_time(False, limit=CHECK_CHUNK, after_id=after_id)
+        if not data:
+            break
+        after_id = data[-1].id
+        db_order.update_work_order_deadline_by_ids([o.id for o in data], next_deadline())
+        sent = arobot.call(_remind(data))
+        ok = sum(1 for r in sent if r is True)
+        result["processed"] += len(data)
+        result["sent"] += ok
+        result["failed"] += len(data) - ok
+        if len(data) < CHECK_CHUNK:
+            break
+
+    if not result["processed"]:
         logger.debug("No work order to check.")
-        return
-
-    for result in data:
-        order_id = result.id
-        chat_id = result.chat_id
-        operator = result.operator
-        db_order.update_work_order_by_id(order_id, "deadline", DEFAULT_DEADLINE)
-        robot.send_card("chat_id", chat_id, card.work_order_how(operator))
+    else:
+        logger.info(f"work order check: {result}")
+    return result
 
 
 def done(chat_id: str):
@@ -77,7 +121,7 @@ def done(chat_id: str):
     robot.update_group_name(chat_id, chat_name_done)
     db_order.update_work_order_by_id(order_id, "status", 1)
     msg = f"<at id={applicant}></at> The work order has been completed."
-    robot.send_card("chat_id", chat_id, card.markdown(msg))
+    combiner.send_card("chat_id", chat_id, card.markdown(msg))
 
 
 def change_operator(chat_id: str, operator_orig: str, operator: str):
@@ -90,7 +134,7 @@ def change_operator(chat_id: str, operator_orig: str, operator: str):
     operator_now = data.operator
     if operator_orig == operator_now:
         msg = f"<at id={operator_orig}></at> The operator has changed to <at id={operator}></at>."
-        robot.send_card("chat_id", chat_id, card.markdown(msg))
+        combiner.send_card("chat_id", chat_id, card.markdown(msg))
     else:
         msg = f"Sorry <at id={operator_orig}></at> you are not the operator, let <at id={operator_now}></at> try again"
-        robot.send_card("chat_id", chat_id, card.markdown(msg))
+        combiner.send_card("chat_id", chat_id, card.markdown(msg))
@@ -5,11 +5,10 @@
     This project is executed when you run `python main.py`.
 """
 import argparse
+import logging
 import os
 
-from concurrent.futures import ThreadPoolExecutor
-
-from flask import Flask
+from flask import Flask, jsonify
 from flask_apscheduler import APScheduler
 from apscheduler.triggers.cron import CronTrigger
 from typing import Any
@@ -19,39 +18,54 @@ from lark_oapi import logger
 from lark_oapi.adapter.flask import parse_req, parse_resp
 from lark_oapi.api.application.v6 import P2ApplicationBotMenuV6
 from lark_oapi.api.im.v1 import (
-    P2ImChatMemberBotAddedV1, P2ImMessageReceiveV1, P2ImMessageReceiveV1Data
+    P2ImChatMemberBotAddedV1, P2ImMessageReceiveV1, P2ImMessageReceiveV1Data,
+    P2ImChatMemberUserAddedV1, P2ImChatMemberUserDeletedV1, P2ImChatMemberUserWithdrawnV1
 )
 
-from lark.command import handle_text
-from utils.config import app_config
+import lark.command as command
+from utils.config import app_config, install_sighup_handler
 import utils.robot as robot
+import utils.lanes as lanes
+import utils.openai_pool as openai_pool
+import utils.combiner as combiner
+import utils.leader as leader
+import utils.spool as spool
+import utils.log as log
+from utils.dedup import Dedup
 import lark.card as card
 import lark.work_order as order
+import lark.chat as chat
+import lark.group as group
 
 app = Flask(__name__)
 
-executor = ThreadPoolExecutor(8)
-
 scheduler = APScheduler()
 
+dedup = Dedup(persistent=app_config().DEDUP_PERSISTENT)
+
 ROBOT_NAME = os.environ.get("ROBOT_NAME", "KaiDiLark")
 
 
 def do_p2_im_message_receive_v1(data: P2ImMessageReceiveV1) -> None:
     """message receive event"""
-    data_str = lark.JSON.marshal(data)
-    logger.debug("receive message\n" + data_str)
+    logger.debug("receive message\n%s", log.lazy_json(data))
 
     event_: P2ImMessageReceiveV1Data = data.event
     if event_ is None or event_.message is None:
         return
-    msg_type = event_.message.message_type
-
-    if msg_type != 'text':
-        logger.error("not support message type: {msg_type}")
+    # drop messages not for the robot before anything else, see command.Dispatcher
+    dispatch = command.dispatch(event_)
+    if dispatch is None:
         return
-
-    executor.submit(handle_text, event_)
+    robot.remember_chat(event_.message.message_id, event_.message.chat_id)
+    event_id = data.header.event_id if data.header is not None else None
+    # a spooled event was de-duplicated on its event id when appended, and may be a replay
+    if not spool.consuming() and (not dedup.first_seen(f"event:{event_id}" if event_id else None)
+                                  or not dedup.first_seen(f"message:{event_.message.message_id}")):
+        log.sampled("duplicate_event", logging.DEBUG, "duplicate event %s, message %s",
+                    event_id, event_.message.message_id)
+        return
+    spool.submit(dispatch.lane, command.run, dispatch)
 
 
 def do_p2_application_bot_menu_v6(data: P2ApplicationBotMenuV6) -> None:
@@ -67,23 +81,35 @@ def do_p2_im_chat_member_bot_added_v1(data: P2ImChatMemberBotAddedV1) -> None:
     if data.event is None:
         logger.error("robot add group data is None")
         return
+    robot.invalidate_group_index()
     robot.send_card('chat_id', data.event.chat_id, card.hello())
 
 
+def do_p2_im_chat_member_user_changed_v1(
+        data: P2ImChatMemberUserAddedV1 | P2ImChatMemberUserDeletedV1 | P2ImChatMemberUserWithdrawnV1) -> None:
+    """ event for users joining or leaving a group, drops the cached member index """
+    if data.event is None:
+        logger.error("group member change data is None")
+        return
+    robot.invalidate_group_members(data.event.chat_id)
+
+
 handler_event = lark.EventDispatcherHandler.builder(
     app_config().ENCRYPT_KEY,
     app_config().VERIFICATION_TOKEN,
-    lark.LogLevel.DEBUG) \
+    log.lark_level()) \
     .register_p2_im_message_receive_v1(do_p2_im_message_receive_v1) \
     .register_p2_application_bot_menu_v6(do_p2_application_bot_menu_v6) \
     .register_p2_im_chat_member_bot_added_v1(do_p2_im_chat_member_bot_added_v1) \
+    .register_p2_im_chat_member_user_added_v1(do_p2_im_chat_member_user_changed_v1) \
+    .register_p2_im_chat_member_user_deleted_v1(do_p2_im_chat_member_user_changed_v1) \
+    .register_p2_im_chat_member_user_withdrawn_v1(do_p2_im_chat_member_user_changed_v1) \
     .build()
 
 
 def do_interactive_card(data: lark.Card) -> Any:
     """card event"""
-    data_str = lark.JSON.marshal(data)
-    logger.debug("receive card\n" + data_str)
+    logger.debug("receive card\n%s", log.lazy_json(data))
     action = data.action
     action_value = action.value
     action_val_str = lark.JSON.marshal(action_value)
@@ -95,23 +121,40 @@ def do_interactive_card(data: lark.Card) -> Any:
     if action_text == "work_order_type":
         logger.debug("work order type select")
         return card.work_order_list(action.option)
+    if action_text == "group_page":
+        logger.debug("group list page")
+        start, cursor = int(action_val_json.get("start", 0)), action_val_json.get("cursor")
+        group_index = robot.cached_group_index()
+        if group_index is not None:
+            return card.groups(group_index, start, cursor)
+        # paging through every group would miss the callback deadline, patch the page once fetched
+        lanes.submit(lanes.FAST, group.patch_groups_page, data.open_message_id, start, cursor)
+        return card.markdown("Loading groups...")
+    if action_text in ("work_order_submit", "done") and not dedup.first_seen(f"card:{data.token}"):
+        logger.debug(f"duplicate card action {action_text}, token {data.token}")
+        return
     if action_text == "work_order_submit":
         logger.debug("work order submit")
-        executor.submit(order.build, data.user_id, action.option)
+        lanes.submit(lanes.ORDER, order.build, data.user_id, action.option)
     if action_text == "done":
         logger.debug("work order done")
-        executor.submit(order.done, data.open_chat_id)
+        lanes.submit(lanes.ORDER, order.done, data.open_chat_id)
 
 
 handler_card = lark.CardActionHandler.builder(
     app_config().ENCRYPT_KEY,
     app_config().VERIFICATION_TOKEN,
-    lark.LogLevel.DEBUG) \
+    log.lark_level()) \
     .register(do_interactive_card).build()
 
 
+event_spool = spool.Spool(handler_event.do_without_validation) if app_config().EVENT_SPOOL else None
+
+
 @app.route('/event', methods=['POST'])
 def events():
+    if event_spool is not None:
+        return parse_resp(event_spool.ingest(handler_event, parse_req()))
     response = handler_event.do(parse_req())
     return parse_resp(response)
 
@@ -122,13 +165,80 @@ def cards():
     return parse_resp(response)
 
 
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        "lanes": lanes.stats(),
+        "dropped": command.stats(),
+        "dedup": dedup.stats(),
+        "robot": robot.stats(),
+        "openai": openai_pool.stats(),
+        "chat": chat.stats(),
+        "combiner": combiner.stats(),
+        "spool": event_spool.stats() if event_spool is not None else {},
+        "log_suppressed": log.stats(),
+    })
+
+
+def check_order():
+    """ run the overdue sweep on the job lane, skipped if the previous one is still queued """
+    lanes.submit(lanes.JOB, order.check)
+
+
+def start_scheduler():
+    """ run the cron jobs, only ever in the leader process """
+    scheduler.init_app(app)
+    scheduler.add_job(id='check_order', func=check_order, trigger=CronTrigger.from_crontab('* 1-18 * * *'))
+    scheduler.start()
+
+
+def start_background():
+    """ per-process background work: the bot's open ID, the event spool consumers, and the scheduler once elected """
+    robot.resolve_bot_open_id()
+    if event_spool is not None:
+        event_spool.start()
+    leader.run_when_leader(start_scheduler)
+
+
+def serve(port: int, workers: int):
+    """
+    Serve with a pre-fork gunicorn server of `workers` processes.
+    Every worker campaigns for leadership, the elected one runs the scheduler.
+    """
+    from gunicorn.app.base import BaseApplication
+    import store.session
+
+    def post_fork(_server, _worker):
+        store.session.dispose_after_fork()
+
+    def post_worker_init(_worker):
+        start_background()
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'0.0.0.0:{port}')
+            self.cfg.set('workers', workers)
+            # the lanes do the work, a worker thread only parses and acks
+            self.cfg.set('threads', 4)
+            self.cfg.set('post_fork', post_fork)
+            self.cfg.set('post_worker_init', post_worker_init)
+
+        def load(self):
+            return app
+
+    Server().run()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--port', default=7788, type=int, help='port number')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='worker processes of the production server, 0 for the development server')
     args = parser.parse_args()
 
-    scheduler.init_app(app)
-    scheduler.add_job(id='check_order', func=order.check, trigger=CronTrigger.from_crontab('* 1-18 * * *'))
-    scheduler.start()
-
-    app.run(host='0.0.0.0', port=args.port)
+    if args.workers > 0:
+        serve(args.port, args.workers)
+    else:
+        install_sighup_handler()
+        start_background()
+        app.run(host='0.0.0.0', port=args.port)
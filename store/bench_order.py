@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    benchmark of the work order queries with and without indexes
+
+    python -m store.bench_order [rows]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import sessionmaker
+
+from store.db_order import Base, WorkOrder, migrate
+
+BATCH = 50000
+
+
+def fill(engine, rows: int):
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        for start in range(0, rows, BATCH):
+            conn.execute(insert(WorkOrder), [
+                {
+                    "chat_id": f"oc_{i}",
+                    "applicant": "user",
+                    "operator": "assist",
+                    # about 1% of the orders are still open
+                    "status": random.random() > 0.01,
+                    "classify": "Work Order",
+                    "description": "bench",
+                    "deadline": now + datetime.timedelta(minutes=random.randint(-600, 600)),
+                }
+                for i in range(start, min(start + BATCH, rows))
+            ])
+
+
+def timeit(fn, repeat: int = 20) -> float:
+    """ Returns the best time of fn() in milliseconds """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def run(session, rows: int):
+    now = datetime.datetime.now()
+    chat_id = f"oc_{rows // 2}"
+    by_chat = timeit(lambda: session.query(WorkOrder).filter_by(chat_id=chat_id).first())
+    overdue = timeit(lambda: session.query(WorkOrder)
+                     .filter(WorkOrder.status == False)  # noqa: E712
+                     .filter(WorkOrder.deadline <= now).all())
+    return by_chat, overdue
+
+
+def main(rows: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(engine)
+        with engine.begin() as conn:
+            for index in WorkOrder.__table__.indexes:
+                conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        print(f"inserting {rows} orders ...")
+        fill(engine, rows)
+        session = sessionmaker(bind=engine)()
+
+        by_chat, overdue = run(session, rows)
+        print(f"no index   chat_id: {by_chat:9.3f} ms   overdue scan: {overdue:9.3f} ms")
+
+        start = time.perf_counter()
+        migrate(engine)
+        print(f"migrate (index build): {time.perf_counter() - start:.1f} s")
+
+        by_chat, overdue = run(session, rows)
+        print(f"indexed    chat_id: {by_chat:9.3f} ms   overdue scan: {overdue:9.3f} ms")
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -3,10 +3,12 @@
 """
     database for work order
 """
-from typing import Type, Optional
+from typing import List, Tuple, Type, Optional
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, func, event
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index, func, event, inspect, text
+from sqlalchemy.orm import declarative_base
+
+from store.session import create_sqlite_engine, create_session_factory, session_scope
 
 Base = declarative_base()
 
@@ -16,7 +18,7 @@ CHAT_P2P_DB_FILE = '/tmp/chat_p2p.db'
 class ChatP2P(Base):
     __tablename__ = 'chat_p2p'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(String(255), nullable=True, default="")
+    user_id = Column(String(255), nullable=True, default="", unique=True, index=True)
     model = Column(String(255), nullable=True, default="")
     prompts = Column(String(1024), nullable=True, default="")
     content = Column(String(1024), nullable=True, default=False)
@@ -24,13 +26,51 @@ class ChatP2P(Base):
     update_time = Column(DateTime, default=func.current_timestamp(), onupdate=func.current_timestamp())
 
 
-engine_chat_p2p = create_engine(f"sqlite:///{CHAT_P2P_DB_FILE}")
-# Create the tables if they don't exist
-Base.metadata.create_all(engine_chat_p2p)
-# Create a session
-SessionChatP2P = sessionmaker(bind=engine_chat_p2p)
-# Set the session
-session_chat_p2p = SessionChatP2P()
+class ChatMessage(Base):
+    """
+    One message of a user's conversation. running_total is the sum of tokens
+    of this user's messages up to and including this one, so a token-bounded
+    window is a range scan instead of a re-count of the history.
+    """
+    __tablename__ = 'chat_message'
+    __table_args__ = (
+        Index('ix_chat_message_user_total', 'user_id', 'running_total'),
+    )
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(String(255), nullable=False)
+    role = Column(String(16), nullable=False)
+    content = Column(Text, nullable=False, default="")
+    tokens = Column(Integer, nullable=False, default=0)
+    running_total = Column(Integer, nullable=False, default=0)
+    create_time = Column(DateTime, default=func.current_timestamp())
+
+
+def migrate(engine):
+    """
+    Create the tables and any index missing from a database made by an older version.
+    Duplicate rows of one user are dropped, keeping the newest, before the unique index is built.
+
+    Args:
+        engine: The engine of the chat p2p database.
+    """
+    Base.metadata.create_all(engine)
+    existing = {index['name'] for index in inspect(engine).get_indexes(ChatP2P.__tablename__)}
+    for index in ChatP2P.__table__.indexes:
+        if index.name in existing:
+            continue
+        if index.unique:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "DELETE FROM chat_p2p WHERE id NOT IN (SELECT MAX(id) FROM chat_p2p GROUP BY user_id)"
+                ))
+        index.create(engine)
+
+
+engine_chat_p2p = create_sqlite_engine(CHAT_P2P_DB_FILE)
+# Create the tables and indexes if they don't exist
+migrate(engine_chat_p2p)
+# Create a session factory, each function opens its own session
+SessionChatP2P = create_session_factory(engine_chat_p2p)
 
 
 # Define a listener function to update the timestamp before a WorkOrder is updated
@@ -55,8 +95,8 @@ def insert_chat_p2p(chat_p2p: ChatP2P):
     Returns:
         None
     """
-    session_chat_p2p.add(chat_p2p)
-    session_chat_p2p.commit()
+    with session_scope(SessionChatP2P) as session:
+        session.add(chat_p2p)
 
 
 def update_chat_p2p_by_user_id(user_id: str, key: str, content: str):
@@ -71,8 +111,8 @@ def update_chat_p2p_by_user_id(user_id: str, key: str, content: str):
     Returns:
         None
     """
-    session_chat_p2p.query(ChatP2P).filter_by(user_id=user_id).update({key: content})
-    session_chat_p2p.commit()
+    with session_scope(SessionChatP2P) as session:
+        session.query(ChatP2P).filter_by(user_id=user_id).update({key: content})
 
 
 def select_chat_p2p_all() -> list[Type[ChatP2P]]:
@@ -82,7 +122,8 @@ def select_chat_p2p_all() -> list[Type[ChatP2P]]:
     Returns:
         list[ChatP2P]: A list of selected work orders or an empty list if not found.
     """
-    return session_chat_p2p.query(ChatP2P).all()
+    with session_scope(SessionChatP2P) as session:
+        return session.query(ChatP2P).all()
 
 
 def select_chat_p2p_by_user_id(user_id: str) -> Optional[Type[ChatP2P]]:
@@ -95,12 +136,72 @@ def select_chat_p2p_by_user_id(user_id: str) -> Optional[Type[ChatP2P]]:
     Returns:
         Optional[ChatP2PEvent]: A selected chat p2p or None if not found.
     """
-    return session_chat_p2p.query(ChatP2P).filter_by(user_id=user_id).first()
+    with session_scope(SessionChatP2P) as session:
+        return session.query(ChatP2P).filter_by(user_id=user_id).first()
 
 
 def clear_chat_p2p_by_user_id(user_id):
     """
     Clears chat data in the database based on the given user ID.
     """
-    session_chat_p2p.query(ChatP2P).filter_by(user_id=user_id).delete()
-    session_chat_p2p.commit()
+    with session_scope(SessionChatP2P) as session:
+        session.query(ChatP2P).filter_by(user_id=user_id).delete()
+
+
+def insert_chat_messages(user_id: str, messages: List[Tuple[str, str, int]]):
+    """
+    Appends messages to a user's conversation in one transaction.
+
+    Parameters:
+        user_id (str): The user ID of the chat person.
+        messages (list[tuple[str, str, int]]): (role, content, tokens) of each message, oldest first.
+
+    Returns:
+        None
+    """
+    with session_scope(SessionChatP2P) as session:
+        last = session.query(ChatMessage.running_total) \
+            .filter_by(user_id=user_id) \
+            .order_by(ChatMessage.running_total.desc()) \
+            .first()
+        running_total = last[0] if last is not None else 0
+        for role, content, tokens in messages:
+            running_total += tokens
+            session.add(ChatMessage(
+                user_id=user_id, role=role, content=content, tokens=tokens, running_total=running_total
+            ))
+
+
+def select_chat_message_window(user_id: str, token_budget: int) -> List[Type[ChatMessage]]:
+    """
+    Selects the latest messages of a user whose tokens sum up to at most token_budget.
+
+    Parameters:
+        user_id (str): The user ID of the chat person.
+        token_budget (int): Max total tokens of the returned messages.
+
+    Returns:
+        list[ChatMessage]: The messages, oldest first.
+    """
+    with session_scope(SessionChatP2P) as session:
+        last = session.query(ChatMessage.running_total) \
+            .filter_by(user_id=user_id) \
+            .order_by(ChatMessage.running_total.desc()) \
+            .first()
+        if last is None:
+            return []
+        # the index bound narrows the scan, the second filter counts each message's own tokens
+        return session.query(ChatMessage) \
+            .filter(ChatMessage.user_id == user_id) \
+            .filter(ChatMessage.running_total > last[0] - token_budget) \
+            .filter(ChatMessage.running_total - ChatMessage.tokens >= last[0] - token_budget) \
+            .order_by(ChatMessage.running_total) \
+            .all()
+
+
+def clear_chat_message_by_user_id(user_id: str):
+    """
+    Clears the conversation of a user.
+    """
+    with session_scope(SessionChatP2P) as session:
+        session.query(ChatMessage).filter_by(user_id=user_id).delete()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    database for cached chat completions
+"""
+import time
+from typing import Optional
+
+from sqlalchemy import Column, String, Text, Float
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base
+
+from store.session import create_sqlite_engine, create_session_factory, session_scope
+
+Base = declarative_base()
+
+COMPLETION_DB_FILE = '/tmp/completion.db'
+
+
+class Completion(Base):
+    __tablename__ = 'completion'
+    key = Column(String(64), primary_key=True)
+    answer = Column(Text, nullable=False)
+    expire_at = Column(Float, nullable=False, index=True)
+
+
+engine_completion = create_sqlite_engine(COMPLETION_DB_FILE)
+# Create the tables if they don't exist
+Base.metadata.create_all(engine_completion)
+# Create a session factory, each function opens its own session
+SessionCompletion = create_session_factory(engine_completion)
+
+
+def upsert_completion(key: str, answer: str, ttl: float):
+    """
+    Insert or replace a cached completion.
+
+    Parameters:
+        key (str): The cache key.
+        answer (str): The completion text.
+        ttl (float): Seconds the completion stays valid.
+    """
+    expire_at = time.time() + ttl
+    statement = insert(Completion).values(key=key, answer=answer, expire_at=expire_at).on_conflict_do_update(
+        index_elements=[Completion.key],
+        set_={"answer": answer, "expire_at": expire_at},
+    )
+    with session_scope(SessionCompletion) as session:
+        session.execute(statement)
+
+
+def select_completion(key: str) -> Optional[str]:
+    """
+    Selects a cached completion that has not expired.
+
+    Parameters:
+        key (str): The cache key.
+
+    Returns:
+        Optional[str]: The completion text or None if not found.
+    """
+    with session_scope(SessionCompletion) as session:
+        row = session.query(Completion.answer) \
+            .filter(Completion.key == key, Completion.expire_at > time.time()) \
+            .first()
+        return row[0] if row is not None else None
+
+
+def delete_expired_completions(max_rows: int) -> int:
+    """
+    Delete expired completions, then the soonest to expire beyond max_rows.
+
+    Returns:
+        int: The number of deleted completions.
+    """
+    with session_scope(SessionCompletion) as session:
+        deleted = session.query(Completion).filter(Completion.expire_at <= time.time()).delete()
+        overflow = session.query(Completion).count() - max_rows
+        if overflow > 0:
+            oldest = session.query(Completion.key).order_by(Completion.expire_at).limit(overflow).subquery()
+            deleted += session.query(Completion).filter(Completion.key.in_(oldest.select())) \
+                .delete(synchronize_session=False)
+        return deleted
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    database for handled event keys
+"""
+import time
+
+from sqlalchemy import Column, String, Float
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base
+
+from store.session import create_sqlite_engine, create_session_factory, session_scope
+
+Base = declarative_base()
+
+EVENT_DB_FILE = '/tmp/event.db'
+
+
+class EventKey(Base):
+    __tablename__ = 'event_key'
+    key = Column(String(255), primary_key=True)
+    expire_at = Column(Float, nullable=False, index=True)
+
+
+engine_event = create_sqlite_engine(EVENT_DB_FILE)
+# Create the tables if they don't exist
+Base.metadata.create_all(engine_event)
+# Create a session factory, each function opens its own session
+SessionEvent = create_session_factory(engine_event)
+
+
+def insert_event_key(key: str, ttl: float) -> bool:
+    """
+    Record an event key unless a live one already exists.
+
+    Parameters:
+        key (str): The event key.
+        ttl (float): Seconds the key stays live.
+
+    Returns:
+        bool: True if the key was recorded, False if it was already live.
+    """
+    now = time.time()
+    # one atomic statement: insert, or take over the key only if it expired
+    statement = insert(EventKey).values(key=key, expire_at=now + ttl).on_conflict_do_update(
+        index_elements=[EventKey.key],
+        set_={"expire_at": now + ttl},
+        where=EventKey.expire_at < now,
+    )
+    with session_scope(SessionEvent) as session:
+        return session.execute(statement).rowcount > 0
+
+
+def delete_expired_event_keys() -> int:
+    """
+    Delete expired event keys.
+
+    Returns:
+        int: The number of deleted keys.
+    """
+    with session_scope(SessionEvent) as session:
+        return session.query(EventKey).filter(EventKey.expire_at < time.time()).delete()
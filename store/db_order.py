@@ -6,8 +6,10 @@
 import datetime
 from typing import List, Type, Optional
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, func, event
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Index, func, event
+from sqlalchemy.orm import declarative_base
+
+from store.session import create_sqlite_engine, create_session_factory, session_scope
 
 Base = declarative_base()
 
@@ -16,8 +18,12 @@ WORK_ORDER_DB_FILE = '/tmp/work_order.db'
 
 class WorkOrder(Base):
     __tablename__ = 'work_order'
+    __table_args__ = (
+        # overdue scan: status == ? and deadline <= ?
+        Index('ix_work_order_status_deadline', 'status', 'deadline'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(String(255), nullable=True, default="")
+    chat_id = Column(String(255), nullable=True, default="", index=True)
     applicant = Column(String(255), nullable=True, default="")
     operator = Column(String(255), nullable=True, default="")
     status = Column(Boolean, nullable=True, default=False)
@@ -28,13 +34,23 @@ class WorkOrder(Base):
     deadline = Column(DateTime, nullable=True, default=func.current_timestamp())
 
 
-engine_work_order = create_engine(f"sqlite:///{WORK_ORDER_DB_FILE}")
-# Create the tables if they don't exist
-Base.metadata.create_all(engine_work_order)
-# Create a session
-SessionWorkOrder = sessionmaker(bind=engine_work_order)
-# Set the session
-session_work_order = SessionWorkOrder()
+def migrate(engine):
+    """
+    Create the tables and any index missing from a database made by an older version.
+
+    Args:
+        engine: The engine of the work order database.
+    """
+    Base.metadata.create_all(engine)
+    for index in WorkOrder.__table__.indexes:
+        index.create(engine, checkfirst=True)
+
+
+engine_work_order = create_sqlite_engine(WORK_ORDER_DB_FILE)
+# Create the tables and indexes if they don't exist
+migrate(engine_work_order)
+# Create a session factory, each function opens its own session
+SessionWorkOrder = create_session_factory(engine_work_order)
 
 
 # Define a listener function to update the timestamp before a WorkOrder is updated
@@ -59,8 +75,8 @@ def insert_work_order(work_order: WorkOrder):
     Returns:
         None
     """
-    session_work_order.add(work_order)
-    session_work_order.commit()
+    with session_scope(SessionWorkOrder) as session:
+        session.add(work_order)
 
 
 def update_work_order_by_id(order_id: int, key: str, content):
@@ -78,8 +94,8 @@ def update_work_order_by_id(order_id: int, key: str, content):
     Raises:
         None
     """
-    session_work_order.query(WorkOrder).filter_by(id=order_id).update({key: content})
-    session_work_order.commit()
+    with session_scope(SessionWorkOrder) as session:
+        session.query(WorkOrder).filter_by(id=order_id).update({key: content})
 
 
 def update_work_order_by_chat_id(chat_id: str,  key: str, content: str):
@@ -94,8 +110,8 @@ def update_work_order_by_chat_id(chat_id: str,  key: str, content: str):
     Returns:
         None
     """
-    session_work_order.query(WorkOrder).filter_by(chat_id=chat_id).update({key: content})
-    session_work_order.commit()
+    with session_scope(SessionWorkOrder) as session:
+        session.query(WorkOrder).filter_by(chat_id=chat_id).update({key: content})
 
 
 def select_work_order_all() -> List[Type[WorkOrder]]:
@@ -105,7 +121,8 @@ def select_work_order_all() -> List[Type[WorkOrder]]:
     Returns:
         list[WorkOrder]: A list of selected work orders or an empty list if not found.
     """
-    return session_work_order.query(WorkOrder).all()
+    with session_scope(SessionWorkOrder) as session:
+        return session.query(WorkOrder).all()
 
 
 def select_work_order_by_chat_id(chat_id: str) -> Optional[Type[WorkOrder]]:
@@ -118,26 +135,53 @@ def select_work_order_by_chat_id(chat_id: str) -> Optional[Type[WorkOrder]]:
     Returns:
         Optional[WorkOrder]: A selected work order or None if not found.
     """
-    return session_work_order.query(WorkOrder).filter_by(chat_id=chat_id).first()
+    with session_scope(SessionWorkOrder) as session:
+        return session.query(WorkOrder).filter_by(chat_id=chat_id).first()
 
 
-def select_work_order_by_status_time(status) -> List[Type[WorkOrder]]:
+def update_work_order_deadline_by_ids(order_ids: List[int], deadline: datetime.datetime) -> int:
+    """
+    Sets the deadline of many work orders in one transaction.
+
+    Parameters:
+        order_ids (list[int]): The IDs of the work orders to update.
+        deadline (datetime): The new deadline.
+
+    Returns:
+        int: The number of updated work orders.
+    """
+    if not order_ids:
+        return 0
+    with session_scope(SessionWorkOrder) as session:
+        return session.query(WorkOrder) \
+            .filter(WorkOrder.id.in_(order_ids)) \
+            .update({"deadline": deadline}, synchronize_session=False)
+
+
+def select_work_order_by_status_time(status, limit: int = None, after_id: int = 0) -> List[Type[WorkOrder]]:
     """
     Selects a work order from the database based on the given status and time.
 
     Parameters:
         status (bool): The status of the work order to select.
+        limit (int): Max number of work orders to return, all if None.
+        after_id (int): Only return work orders with a greater ID, to read in chunks.
 
     Returns:
         list[WorkOrder]: A list of selected work orders or an empty list if not found.
     """
     localtime = datetime.datetime.now()
-    return (
-        session_work_order.query(WorkOrder)
-        .filter(WorkOrder.status == status)
-        .filter(WorkOrder.deadline <= localtime)
-        .all()
-    )
+    with session_scope(SessionWorkOrder) as session:
+        query = (
+            session.query(WorkOrder)
+            .filter(WorkOrder.status == status)
+            .filter(WorkOrder.deadline <= localtime)
+            .filter(WorkOrder.id > after_id)
+            .order_by(WorkOrder.id)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    database for the inbound event spool
+"""
+import time
+from typing import Collection, List, Tuple
+
+from sqlalchemy import Column, Integer, String, Text, Float, Boolean, Index, select, update, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import declarative_base
+
+from store.session import create_sqlite_engine, create_session_factory, session_scope
+
+Base = declarative_base()
+
+SPOOL_DB_FILE = '/tmp/spool.db'
+
+
+class SpoolEvent(Base):
+    __tablename__ = 'spool_event'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Lark's event id, a redelivered event is not spooled twice
+    event_id = Column(String(64), unique=True)
+    payload = Column(Text, nullable=False)
+    create_time = Column(Float, nullable=False)
+    # pid of the consumer holding the event, and until when
+    claimed_by = Column(Integer, nullable=False, default=0)
+    claimed_until = Column(Float, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    done = Column(Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        Index('ix_spool_event_done_claimed', 'done', 'claimed_until'),
+    )
+
+
+engine_spool = create_sqlite_engine(SPOOL_DB_FILE)
+# Create the tables if they don't exist
+Base.metadata.create_all(engine_spool)
+# Create a session factory, each function opens its own session
+SessionSpool = create_session_factory(engine_spool)
+
+
+def append_event(event_id: str, payload: str) -> bool:
+    """
+    Append an event to the spool.
+
+    Parameters:
+        event_id (str): The Lark event id, None if the event has none.
+        payload (str): The decrypted event body.
+
+    Returns:
+        bool: True if appended, False if the event id was already spooled.
+    """
+    statement = insert(SpoolEvent).values(
+        event_id=event_id, payload=payload, create_time=time.time()
+    ).on_conflict_do_nothing(index_elements=[SpoolEvent.event_id])
+    with session_scope(SessionSpool) as session:
+        return session.execute(statement).rowcount > 0
+
+
+def claim_events(owner: int, limit: int, lease: float, max_attempts: int,
+                 exclude: Collection[int] = ()) -> List[Tuple[int, str]]:
+    """
+    Claim the oldest events that are neither done nor held by a live lease.
+    One UPDATE ... RETURNING statement, so two consumers never claim the same event.
+
+    Parameters:
+        owner (int): The claiming process id.
+        limit (int): Max events claimed.
+        lease (float): Seconds the claim holds before the event is handed out again.
+        max_attempts (int): Events claimed this many times are no longer handed out.
+        exclude (Collection[int]): Ids the caller still holds, never claimed again even if their lease ran out.
+
+    Returns:
+        List[Tuple[int, str]]: (id, payload) of the claimed events, oldest first.
+    """
+    now = time.time()
+    claimable = select(SpoolEvent.id) \
+        .where(SpoolEvent.done.is_(False), SpoolEvent.claimed_until < now, SpoolEvent.attempts < max_attempts)
+    if exclude:
+        claimable = claimable.where(SpoolEvent.id.notin_(list(exclude)))
+    claimable = claimable \
+        .order_by(SpoolEvent.id) \
+        .limit(limit) \
+        .scalar_subquery()
+    statement = update(SpoolEvent) \
+        .where(SpoolEvent.id.in_(claimable)) \
+        .values(claimed_by=owner, claimed_until=now + lease, attempts=SpoolEvent.attempts + 1) \
+        .returning(SpoolEvent.id, SpoolEvent.payload)
+    with session_scope(SessionSpool) as session:
+        rows = session.execute(statement).all()
+    return sorted((row.id, row.payload) for row in rows)
+
+
+def checkpoint_events(ids: List[int]):
+    """ Mark events as processed """
+    if not ids:
+        return
+    with session_scope(SessionSpool) as session:
+        session.query(SpoolEvent).filter(SpoolEvent.id.in_(ids)).update({"done": True}, synchronize_session=False)
+
+
+def renew_claims(owner: int, ids: List[int], lease: float) -> int:
+    """
+    Extend the leases of events this process still works on.
+
+    Returns:
+        int: The number of renewed claims.
+    """
+    if not ids:
+        return 0
+    with session_scope(SessionSpool) as session:
+        return session.query(SpoolEvent) \
+            .filter(SpoolEvent.id.in_(ids), SpoolEvent.claimed_by == owner, SpoolEvent.done.is_(False)) \
+            .update({"claimed_until": time.time() + lease}, synchronize_session=False)
+
+
+def requeue_events(ids: List[int], delay: float):
+    """
+    Hand events out again after a delay, without counting the claim as an attempt,
+    e.g. after a lane shed them.
+    """
+    if not ids:
+        return
+    with session_scope(SessionSpool) as session:
+        session.query(SpoolEvent).filter(SpoolEvent.id.in_(ids), SpoolEvent.done.is_(False)) \
+            .update({"claimed_until": time.time() + delay, "attempts": SpoolEvent.attempts - 1},
+                    synchronize_session=False)
+
+
+def select_claim_owners() -> List[int]:
+    """ Process ids holding live claims on unprocessed events """
+    with session_scope(SessionSpool) as session:
+        rows = session.query(SpoolEvent.claimed_by).distinct() \
+            .filter(SpoolEvent.done.is_(False), SpoolEvent.claimed_until >= time.time()).all()
+        return [row[0] for row in rows]
+
+
+def release_claims(owners: List[int]) -> int:
+    """
+    Make the unprocessed events claimed by these processes claimable again.
+
+    Returns:
+        int: The number of released events.
+    """
+    if not owners:
+        return 0
+    with session_scope(SessionSpool) as session:
+        return session.query(SpoolEvent) \
+            .filter(SpoolEvent.done.is_(False), SpoolEvent.claimed_by.in_(owners)) \
+            .update({"claimed_until": 0}, synchronize_session=False)
+
+
+def delete_done_events(before: float) -> int:
+    """
+    Delete processed events created before a time.
+
+    Returns:
+        int: The number of deleted events.
+    """
+    with session_scope(SessionSpool) as session:
+        return session.query(SpoolEvent) \
+            .filter(SpoolEvent.done.is_(True), SpoolEvent.create_time < before) \
+            .delete(synchronize_session=False)
+
+
+def count_events(max_attempts: int) -> dict:
+    """ Unprocessed events, and those given up after max_attempts """
+    with session_scope(SessionSpool) as session:
+        pending = session.query(func.count(SpoolEvent.id)) \
+            .filter(SpoolEvent.done.is_(False), SpoolEvent.attempts < max_attempts).scalar()
+        dead = session.query(func.count(SpoolEvent.id)) \
+            .filter(SpoolEvent.done.is_(False), SpoolEvent.attempts >= max_attempts).scalar()
+        return {"pending": pending, "dead": dead}
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    engine and session helpers shared by the store modules
+"""
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+
+# Connections kept per database, sized for the lane workers plus the scheduler
+POOL_SIZE = 16
+POOL_MAX_OVERFLOW = 16
+# Milliseconds a writer waits for the SQLite lock before "database is locked"
+BUSY_TIMEOUT = 5000
+
+_engines: List[Engine] = []
+
+
+def create_sqlite_engine(db_file: str) -> Engine:
+    """
+    Creates a pooled engine for a SQLite file in WAL mode, so readers
+    do not block the writer and writers wait instead of failing.
+
+    Args:
+        db_file (str): Path of the SQLite file.
+
+    Returns:
+        Engine: The engine.
+    """
+    engine = create_engine(
+        f"sqlite:///{db_file}",
+        connect_args={"check_same_thread": False},
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        pool_pre_ping=True,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    _engines.append(engine)
+    return engine
+
+
+def dispose_after_fork():
+    """
+    Drop the pooled connections inherited from the parent process without
+    closing them, so a forked worker opens its own.
+    """
+    for engine in _engines:
+        engine.dispose(close=False)
+
+
+def create_session_factory(engine: Engine) -> sessionmaker:
+    """
+    Objects stay readable after commit, since they are used after their session closed.
+    """
+    return sessionmaker(bind=engine, expire_on_commit=False)
+
+
+@contextmanager
+def session_scope(factory: sessionmaker) -> Iterator[Session]:
+    """
+    One session per unit of work: commit on success, rollback on error, always close.
+
+    Args:
+        factory (sessionmaker): The session factory of the database.
+    """
+    session = factory()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    OpenAIPool key failover against the local OpenAI stub
+
+    python -m pytest tests
+"""
+import threading
+
+import openai
+import pytest
+
+import utils.openai_stub as openai_stub
+from utils.openai_pool import OpenAIPool
+
+MESSAGES = [{"role": "user", "content": "hello stub"}]
+
+
+@pytest.fixture
+def base_url():
+    # port 0: the OS picks a free port
+    server = openai_stub.serve(0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _answer(response) -> str:
+    return response.choices[0].message.content
+
+
+def test_good_key(base_url):
+    pool = OpenAIPool(["good-1"], base_url)
+    assert _answer(pool.create(model="stub", messages=MESSAGES)) == "echo: hello stub"
+    assert pool.slots[0].requests == 1
+
+
+def test_failover_across_429_and_500(base_url):
+    pool = OpenAIPool(["429-key", "500-key", "good-key"], base_url)
+    assert _answer(pool.create(model="stub", messages=MESSAGES)) == "echo: hello stub"
+    limited, broken, good = pool.slots
+    assert (limited.requests, limited.rate_limited) == (1, 1)
+    assert (broken.requests, broken.errors) == (1, 1)
+    assert good.requests == 1
+
+
+def test_rate_limited_key_cools_down(base_url):
+    pool = OpenAIPool(["429-key", "good-key"], base_url)
+    pool.create(model="stub", messages=MESSAGES)
+    limited, good = pool.slots
+    # the stub sends Retry-After: 1
+    assert 0 < limited.stats()["cooldown"] <= 1
+    pool.create(model="stub", messages=MESSAGES)
+    assert limited.requests == 1
+    assert good.requests == 2
+
+
+def test_server_error_does_not_cool_down(base_url):
+    pool = OpenAIPool(["500-key", "good-key"], base_url)
+    pool.create(model="stub", messages=MESSAGES)
+    pool.create(model="stub", messages=MESSAGES)
+    broken, good = pool.slots
+    # round-robin goes back to the failing key, it is not cooling down
+    assert broken.stats()["cooldown"] == 0
+    assert broken.errors == 2
+    assert good.requests == 2
+
+
+def test_all_keys_failing_raises_last_error(base_url):
+    with pytest.raises(openai.InternalServerError):
+        OpenAIPool(["500-a", "500-b"], base_url).create(model="stub", messages=MESSAGES)
+    with pytest.raises(openai.RateLimitError):
+        OpenAIPool(["429-a"], base_url).create(model="stub", messages=MESSAGES)
+
+
+def test_streaming(base_url):
+    pool = OpenAIPool(["429-key", "good-key"], base_url)
+    stream = pool.create(model="stub", messages=MESSAGES, stream=True)
+    chunks = list(stream)
+    text = "".join(chunk.choices[0].delta.content or "" for chunk in chunks)
+    assert text.strip() == "echo: hello stub"
+    assert chunks[-1].choices[0].finish_reason == "stop"
+    assert pool.slots[0].rate_limited == 1
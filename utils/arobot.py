@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    asyncio robot apis
+
+    Same surface as utils.robot, built on the async methods of lark_oapi
+    (acreate, areply, apatch, ...). All coroutines run on one background
+    event loop, so thousands of calls can be in flight without holding a
+    worker thread each. Synchronous code uses call() / submit().
+"""
+import asyncio
+import threading
+import uuid
+from concurrent.futures import Future
+from typing import Any, Awaitable, List, Optional, Union
+
+from lark_oapi import logger
+
+from lark_oapi.api.im.v1 import (
+    CreateMessageRequest, CreateMessageRequestBody,
+    ReplyMessageRequest, ReplyMessageRequestBody, ReplyMessageResponseBody, CreateChatResponseBody,
+    ListChat, PatchMessageRequest, PatchMessageRequestBody, GetChatRequest,
+    GetChatResponseBody, Message, ListMember
+)
+
+import utils.client as client
+import utils.ratelimit as ratelimit
+import utils.robot as robot
+
+# Max outbound calls in flight on the loop
+MAX_CONCURRENCY = 1000
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """
+    Returns the robot event loop, starting it in a daemon thread on first use.
+    """
+    global _loop, _semaphore
+    if _loop is not None:
+        return _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="robot-loop", daemon=True)
+            thread.start()
+            _semaphore = asyncio.run_coroutine_threadsafe(_new_semaphore(), loop).result()
+            _loop = loop
+    return _loop
+
+
+async def _new_semaphore() -> asyncio.Semaphore:
+    return asyncio.Semaphore(MAX_CONCURRENCY)
+
+
+def submit(coro: Awaitable) -> Future:
+    """
+    Schedule a coroutine on the robot loop from any thread.
+
+    Returns:
+        concurrent.futures.Future: The future of the coroutine result.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def call(coro: Awaitable, timeout: float = None) -> Any:
+    """
+    Run a coroutine on the robot loop and wait for its result.
+    Must not be called from the robot loop itself.
+    """
+    return submit(coro).result(timeout)
+
+
+async def _request_option():
+    """ The request option; a token fetch, which blocks on HTTP, runs off the loop """
+    if client.token_fresh():
+        return client.request_option()
+    return await asyncio.get_running_loop().run_in_executor(None, client.request_option)
+
+
+async def _call(method, request):
+    return await method(request, await _request_option())
+
+
+async def _invoke(method, request, what: str, endpoint: str, key: str = None):
+    """
+    Await one Lark API call under the concurrency limit and the shared rate limiter.
+    The tenant token comes from the shared cache; a missing one is fetched off the loop.
+    """
+    async with _semaphore:
+        response = await ratelimit.acall(endpoint, key, lambda: _call(method, request))
+    if not response.success():
+        logger.error(f"{what} failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
+    return response
+
+
+async def send_msg(id_type: str = 'user_id', id_to: str = None, content: Union[str, dict] = None,
+                   msg_type: str = 'text') -> bool:
+    request = CreateMessageRequest.builder() \
+        .receive_id_type(id_type) \
+        .request_body(CreateMessageRequestBody.builder()
+                      .receive_id(id_to)
+                      .content(robot.content_json(content))
+                      .msg_type(msg_type)
+                      .uuid(str(uuid.uuid4()))
+                      .build()).build()
+    response = await _invoke(client.get_client().im.v1.message.acreate, request, "send msg", "message.create", id_to)
+    return response.success()
+
+
+async def send_text(id_type: str = 'user_id', id_to: str = None, message: str = None) -> bool:
+    return await send_msg(id_type, id_to, {'text': message})
+
+
+async def send_card(id_type: str = 'user_id', id_to: str = None, content: Union[str, dict] = None) -> bool:
+    return await send_msg(id_type, id_to, content, msg_type='interactive')
+
+
+async def reply_msg(msg_id: str, content: Union[str, dict] = None, msg_type: str = 'text') -> ReplyMessageResponseBody:
+    request: ReplyMessageRequest = ReplyMessageRequest.builder() \
+        .message_id(msg_id) \
+        .request_body(ReplyMessageRequestBody.builder()
+                      .content(robot.content_json(content))
+                      .msg_type(msg_type)
+                      .uuid(str(uuid.uuid4()))
+                      .build()).build()
+    response = await _invoke(client.get_client().im.v1.message.areply, request, "reply msg", "message.reply",
+                             robot.reply_key(msg_id))
+    return response.data
+
+
+async def reply_text(msg_id: str, message: str = None) -> ReplyMessageResponseBody:
+    return await reply_msg(msg_id, {'text': message})
+
+
+async def reply_card(msg_id: str, content: Union[str, dict] = None) -> ReplyMessageResponseBody:
+    return await reply_msg(msg_id, content, msg_type='interactive')
+
+
+async def refresh_card(id_to: str = None, content: Union[str, dict] = None) -> bool:
+    request: PatchMessageRequest = PatchMessageRequest.builder() \
+        .message_id(id_to) \
+        .request_body(PatchMessageRequestBody.builder()
+                      .content(robot.content_json(content))
+                      .build()).build()
+    response = await _invoke(client.get_client().im.v1.message.apatch, request, "refresh card", "message.patch", id_to)
+    return response.success()
+
+
+async def create_group(chat_name: str, id_list: list, chat_description: str) -> CreateChatResponseBody:
+    request = robot.create_group_request(chat_name, id_list, chat_description)
+    response = await _invoke(client.get_client().im.v1.chat.acreate, request, "create group", "chat.create")
+    if response.success():
+        robot.invalidate_group_index()
+    return response.data
+
+
+async def get_group_info(chat_id: str) -> GetChatResponseBody:
+    request: GetChatRequest = GetChatRequest.builder().chat_id(chat_id).user_id_type('user_id').build()
+    response = await _invoke(client.get_client().im.v1.chat.aget, request, "get group info", "chat.get")
+    return response.data
+
+
+async def delete_group(chat_id: str) -> bool:
+    request = robot.delete_group_request(chat_id)
+    response = await _invoke(client.get_client().im.v1.chat.adelete, request, "delete group", "chat.delete", chat_id)
+    if response.success():
+        robot.invalidate_group_index()
+    return response.success()
+
+
+async def update_group_name(chat_id: str, chat_name: str) -> bool:
+    request = robot.update_group_name_request(chat_id, chat_name)
+    response = await _invoke(client.get_client().im.v1.chat.aupdate, request, "update group name",
+                             "chat.update", chat_id)
+    if response.success():
+        robot.invalidate_group_index()
+    return response.success()
+
+
+async def _paginate(method, build, what: str, endpoint: str, key: str = None) -> list:
+    """
+    Awaits every page of a list api.
+
+    Args:
+        method: The async api method, e.g. im.v1.chat.alist.
+        build: Function of a page token (None for the first page) returning the request.
+        what (str): Name of the call for logging.
+        endpoint (str): The Lark api, see ratelimit.ENDPOINT_QUOTAS.
+        key (str): The chat the call targets, None if not chat-scoped.
+
+    Raises:
+        robot.PageError: A page failed, the pages already read are incomplete.
+    """
+    items = []
+    page_token = None
+    while True:
+        try:
+            response = await _invoke(method, build(page_token), what, endpoint, key)
+        except Exception as e:
+            raise robot.PageError(f"{what} failed: {e}") from e
+        if not response.success():
+            raise robot.PageError(f"{what} failed, code: {response.code}, msg: {response.msg}")
+        items.extend(response.data.items or [])
+        if not response.data.has_more or not response.data.page_token:
+            return items
+        page_token = response.data.page_token
+
+
+async def get_group_list() -> List[ListChat]:
+    """ See robot.get_group_list; raises robot.PageError if a page fails """
+    return await _paginate(client.get_client().im.v1.chat.alist, robot.group_list_request,
+                           "get group list", "chat.list")
+
+
+async def get_group_members(chat_id: str) -> List[ListMember]:
+    """ See robot.get_group_members; raises robot.PageError if a page fails """
+    return await _paginate(client.get_client().im.v1.chat_members.aget,
+                           lambda page_token: robot.group_members_request(chat_id, page_token),
+                           "get group members", "chat_members.get", chat_id)
+
+
+async def get_chat_history(chat_id: str) -> List[Message]:
+    """ See robot.get_chat_history; raises robot.PageError if a page fails """
+    return await _paginate(client.get_client().im.v1.message.alist,
+                           lambda page_token: robot.chat_history_request(chat_id, page_token),
+                           "get chat history", "message.list", chat_id)
+
+
+async def gather(*coros, limit: int = None) -> list:
+    """
+    Run coroutines concurrently and return their results in order.
+    Exceptions are returned in place of results instead of raised.
+
+    Args:
+        limit (int): Optional cap on how many of these coros run at once.
+    """
+    if limit is None:
+        return await asyncio.gather(*coros, return_exceptions=True)
+    sem = asyncio.Semaphore(limit)
+
+    async def _run(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(_run(c) for c in coros), return_exceptions=True)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    shared lark client and tenant access token cache
+
+    lark_oapi's own TokenManager already caches the tenant token process-wide,
+    but it fetches a new one inline, in the first request after expiry, on
+    whatever thread (or event loop) makes that request. Here the token is
+    refreshed in the background ahead of expiry, so once the first token is
+    fetched no api call waits on a token round trip.
+"""
+import json
+import threading
+import time
+from typing import Optional
+
+import lark_oapi as lark
+from lark_oapi import logger
+from lark_oapi.api.auth.v3 import (
+    InternalTenantAccessTokenRequest, InternalTenantAccessTokenRequestBody, InternalTenantAccessTokenResponse
+)
+
+from utils.config import app_config, add_reload_hook
+import utils.log as log
+import utils.transport as transport
+
+# Refresh the tenant token this many seconds before it expires
+TOKEN_REFRESH_AHEAD = 300
+
+_lock = threading.RLock()
+_client: Optional[lark.Client] = None
+_client_app: Optional[tuple] = None
+_token: Optional[str] = None
+_token_expire_at = 0.0
+_refreshing = False
+
+_stats = {
+    "client_builds": 0,
+    "client_hits": 0,
+    "token_refreshes": 0,
+    "token_refresh_failures": 0,
+    "token_hits": 0,
+    "token_background_refreshes": 0,
+}
+
+
+def _build_client() -> lark.Client:
+    """
+    Creates and configures a new Lark client.
+    The tenant token is supplied per request by request_option(),
+    and calls go over the pooled transport.
+    """
+    global _client_app
+    transport.install()
+    config = app_config()
+    _client_app = (config.APP_ID, config.APP_SECRET)
+    return lark.Client.builder() \
+        .app_id(config.APP_ID) \
+        .app_secret(config.APP_SECRET) \
+        .enable_set_token(True) \
+        .log_level(log.lark_level()) \
+        .build()
+
+
+def get_client() -> lark.Client:
+    """
+    Returns the process-wide Lark client, building it on first use.
+    The client is stateless per request and safe to share across threads.
+    """
+    global _client
+    cli = _client
+    if cli is not None:
+        _stats["client_hits"] += 1
+        return cli
+    with _lock:
+        if _client is None:
+            _client = _build_client()
+            _stats["client_builds"] += 1
+        return _client
+
+
+def _fetch_token(cli: lark.Client):
+    config = app_config()
+    request: InternalTenantAccessTokenRequest = InternalTenantAccessTokenRequest.builder() \
+        .request_body(InternalTenantAccessTokenRequestBody.builder()
+                      .app_id(config.APP_ID)
+                      .app_secret(config.APP_SECRET)
+                      .build()).build()
+    response: InternalTenantAccessTokenResponse = cli.auth.v3.tenant_access_token.internal(request)
+    if not response.success():
+        logger.error(
+            f"get tenant token failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
+        )
+        return None, 0
+    body = json.loads(response.raw.content)
+    return body.get("tenant_access_token"), int(body.get("expire", 0))
+
+
+def _refresh() -> Optional[str]:
+    """ Fetch a new token; on failure keep the old one while it is still valid """
+    global _token, _token_expire_at
+    with _lock:
+        now = time.time()
+        if _token is not None and now < _token_expire_at - TOKEN_REFRESH_AHEAD:
+            return _token
+        token, expire = _fetch_token(get_client())
+        if token is None:
+            _stats["token_refresh_failures"] += 1
+            return _token if now < _token_expire_at else None
+        _token = token
+        _token_expire_at = now + expire
+        _stats["token_refreshes"] += 1
+        return _token
+
+
+def _refresh_in_background():
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+
+    def run():
+        global _refreshing
+        try:
+            _refresh()
+            _stats["token_background_refreshes"] += 1
+        except Exception as e:
+            logger.error(f"tenant token refresh failed: {e}")
+        finally:
+            _refreshing = False
+
+    threading.Thread(target=run, name="token-refresh", daemon=True).start()
+
+
+def token_fresh() -> bool:
+    """ True if tenant_token() will answer without a blocking fetch """
+    return _token is not None and time.time() < _token_expire_at
+
+
+def tenant_token() -> Optional[str]:
+    """
+    Returns the cached tenant access token. Within TOKEN_REFRESH_AHEAD seconds
+    of expiry it is refreshed in the background while the old one is served;
+    only a missing or expired token is fetched inline.
+    """
+    now = time.time()
+    token, expire_at = _token, _token_expire_at
+    if token is not None and now < expire_at:
+        if now >= expire_at - TOKEN_REFRESH_AHEAD:
+            _refresh_in_background()
+        _stats["token_hits"] += 1
+        return token
+    return _refresh()
+
+
+def request_option() -> lark.RequestOption:
+    """ Request option carrying the cached tenant token """
+    builder = lark.RequestOption.builder()
+    token = tenant_token()
+    if token is not None:
+        builder.tenant_access_token(token)
+    return builder.build()
+
+
+def reset():
+    """ Drop the shared client and token, e.g. after APP_ID/APP_SECRET changed """
+    global _client, _token, _token_expire_at
+    with _lock:
+        _client = None
+        _token = None
+        _token_expire_at = 0.0
+
+
+def stats() -> dict:
+    """ Client and token cache counters """
+    return dict(_stats, token_ttl=max(0, int(_token_expire_at - time.time())))
+
+
+def _on_config_reload(config):
+    if _client_app is not None and _client_app != (config.APP_ID, config.APP_SECRET):
+        reset()
+
+
+add_reload_hook(_on_config_reload)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    outbound card combiner
+
+    Cards sent to the same chat within a short window are merged into one
+    card, separated by rules, so a burst costs one api call and one
+    notification. A merge is capped in cards and bytes; the overflow goes
+    out as further cards, in order. Opt-in with SEND_COALESCE_MS > 0.
+"""
+import heapq
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+from lark_oapi import logger
+
+import utils.robot as robot
+from utils.config import app_config
+
+# Max cards merged into one, and max bytes of a merged card (Lark rejects cards over 30 KB)
+COMBINE_MAX_CARDS = 10
+COMBINE_MAX_BYTES = 28 * 1024
+# Threads sending merged cards, one chat is only ever sent by one of them at a time
+COMBINE_SENDERS = 4
+
+Card = Union[str, dict]
+_Key = Tuple[str, str]
+
+
+def _as_dict(content: Card) -> dict:
+    return json.loads(content) if isinstance(content, str) else content
+
+
+def _elements(content: dict) -> list:
+    """ The card elements, with its header title turned into a bold line """
+    elements = list(content.get("elements") or [])
+    title = (content.get("header") or {}).get("title", {}).get("content")
+    if title:
+        elements.insert(0, {"tag": "div", "text": {"tag": "lark_md", "content": f"**{title}**"}})
+    return elements
+
+
+def merge(cards: List[Card]) -> List[Card]:
+    """
+    Merge cards into as few cards as the caps allow, keeping their order.
+    Cards without plain elements (templates, i18n cards) are never merged.
+
+    Returns:
+        List[Card]: The cards to send; a card that was not merged is returned as given.
+    """
+    result: List[Card] = []
+    batch: List[Card] = []
+    batch_elements: list = []
+
+    def flush():
+        if len(batch) == 1:
+            result.append(batch[0])
+        elif batch:
+            result.append({"config": _as_dict(batch[0]).get("config", {"wide_screen_mode": True}),
+                           "elements": batch_elements[:]})
+        batch.clear()
+        batch_elements.clear()
+
+    for content in cards:
+        parsed = _as_dict(content)
+        if "elements" not in parsed or "i18n_elements" in parsed:
+            flush()
+            result.append(content)
+            continue
+        elements = _elements(parsed)
+        joined = batch_elements + [{"tag": "hr"}] + elements if batch_elements else elements
+        if batch and (len(batch) >= COMBINE_MAX_CARDS or len(json.dumps(joined)) > COMBINE_MAX_BYTES):
+            flush()
+            joined = elements
+        batch.append(content)
+        batch_elements[:] = joined
+    flush()
+    return result
+
+
+class Combiner:
+    def __init__(self, window: float):
+        """
+        Args:
+            window (float): Seconds a chat's first card waits for more cards.
+        """
+        self.window = window
+        self.queued = 0
+        self.sent = 0
+        self._pending: Dict[_Key, List[Tuple[Card, Future]]] = {}
+        self._due: List[Tuple[float, _Key]] = []
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._senders = ThreadPoolExecutor(COMBINE_SENDERS, thread_name_prefix="combiner")
+        self._thread = threading.Thread(target=self._run, name="combiner", daemon=True)
+        self._thread.start()
+
+    def send_card(self, id_type: str, id_to: str, content: Card) -> Future:
+        """
+        Queue a card for the chat.
+
+        Returns:
+            Future: Resolves to True once the card (merged or not) was sent.
+        """
+        future = Future()
+        key = (id_type, id_to)
+        with self._cond:
+            self.queued += 1
+            if key not in self._pending:
+                self._pending[key] = []
+                heapq.heappush(self._due, (time.monotonic() + self.window, key))
+                self._cond.notify()
+            self._pending[key].append((content, future))
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._cond.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                _, key = heapq.heappop(self._due)
+                if key in self._busy:
+                    # the previous batch is still going out, keep collecting; from now, not from
+                    # the stale due time, which would spin while a send is slower than the window
+                    heapq.heappush(self._due, (time.monotonic() + self.window, key))
+                    continue
+                items = self._pending.pop(key)
+                self._busy.add(key)
+            self._senders.submit(self._send, key, items)
+
+    def _send(self, key: _Key, items: List[Tuple[Card, Future]]):
+        try:
+            cards = merge([content for content, _ in items])
+            ok = True
+            for content in cards:
+                ok = robot.send_card(key[0], key[1], content) and ok
+                self.sent += 1
+            for _, future in items:
+                future.set_result(ok)
+        except Exception as e:
+            logger.error(f"combined send to {key[1]} failed: {e}")
+            for _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            with self._cond:
+                self._busy.discard(key)
+
+    def stats(self) -> dict:
+        return {"window": self.window, "queued": self.queued, "sent": self.sent, "pending": len(self._pending)}
+
+
+_combiner = None
+_combiner_lock = threading.Lock()
+
+
+def _get_combiner(window: float) -> Combiner:
+    global _combiner
+    with _combiner_lock:
+        if _combiner is None:
+            _combiner = Combiner(window)
+        _combiner.window = window
+        return _combiner
+
+
+def send_card(id_type: str = 'chat_id', id_to: str = None, content: Card = None) -> Future:
+    """
+    Send a card, merged with other cards to the same chat if SEND_COALESCE_MS > 0,
+    else right away.
+
+    Returns:
+        Future: Resolves to True if the card was sent.
+    """
+    window_ms = app_config().SEND_COALESCE_MS
+    if window_ms > 0:
+        return _get_combiner(window_ms / 1000).send_card(id_type, id_to, content)
+    future = Future()
+    future.set_result(robot.send_card(id_type, id_to, content))
+    return future
+
+
+def stats() -> dict:
+    return _combiner.stats() if _combiner is not None else {}
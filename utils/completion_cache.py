@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    chat completion cache
+
+    Answers are cached by (model, system prompts, normalized question),
+    so repeated FAQ-type questions are answered without calling OpenAI,
+    whoever asks them and whatever they asked before.
+    In-memory LRU, optionally backed by SQLite to survive restarts.
+"""
+import hashlib
+import json
+from typing import List, Optional
+
+from lark_oapi import logger
+
+from utils.cache import TTLCache
+
+# Seconds a cached answer is served and max answers kept
+COMPLETION_CACHE_TTL = 24 * 3600
+COMPLETION_CACHE_SIZE = 1000
+# Trim the SQLite cache every this many stores
+COMPLETION_PURGE_EVERY = 100
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+
+def cache_key(model: str, messages: List[dict]) -> str:
+    """
+    Key of a request: system prompts verbatim, other messages with
+    whitespace and case normalized.
+    """
+    parts = [model] + [
+        [m["role"], m["content"] if m["role"] == "system" else _normalize(m["content"])] for m in messages
+    ]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, persistent: bool = False):
+        self.persistent = persistent
+        self._memory = TTLCache(COMPLETION_CACHE_TTL, COMPLETION_CACHE_SIZE)
+        self._stores = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self._memory.get(key)
+        if answer is None and self.persistent:
+            answer = self._db_call("select_completion", key)
+            if answer is not None:
+                self._memory.set(key, answer)
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    def set(self, key: str, answer: str):
+        self._memory.set(key, answer)
+        if self.persistent:
+            self._db_call("upsert_completion", key, answer, COMPLETION_CACHE_TTL)
+            self._stores += 1
+            if self._stores % COMPLETION_PURGE_EVERY == 0:
+                self._db_call("delete_expired_completions", COMPLETION_CACHE_SIZE)
+
+    @staticmethod
+    def _db_call(name: str, *args):
+        import store.db_completion as db_completion
+        try:
+            return getattr(db_completion, name)(*args)
+        except Exception as e:
+            logger.error(f"completion cache db failed: {e}")
+            return None
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._memory), "persistent": self.persistent}
@@ -3,12 +3,23 @@
 """
     config
 """
+import os
+import signal
+import threading
+import time
 import yaml
-from dataclasses import dataclass
-import inspect
+from dataclasses import dataclass, fields
+from typing import Callable, List, Optional
 
+from lark_oapi import logger
 
-@dataclass
+CONFIG_FILE = 'config.yaml'
+
+# Minimum seconds between two mtime checks of the config file
+CONFIG_CHECK_INTERVAL = 1.0
+
+
+@dataclass(frozen=True)
 class AppConfig:
     ROBOT_NAME: str
     APP_ID: str
@@ -17,11 +28,28 @@ class AppConfig:
     VERIFICATION_TOKEN: str
     CHAT_KEY: str
     ORDER_ASSISTANT: str
+    # Keep handled event keys in SQLite so retries are caught across restarts
+    DEDUP_PERSISTENT: bool = False
+    # OpenAI compatible endpoint, e.g. the local stub: http://127.0.0.1:7799/v1
+    CHAT_BASE_URL: str = None
+    # Serve repeated questions from a completion cache, optionally kept in SQLite; keyed on the
+    # system prompts and the question, answers are stored only from turns without history
+    CHAT_CACHE: bool = False
+    CHAT_CACHE_PERSISTENT: bool = False
+    # Merge cards sent to the same chat within this many milliseconds, 0 to send each right away
+    SEND_COALESCE_MS: int = 0
+    # Append verified events to a SQLite journal and ack at once, a consumer pool handles them
+    EVENT_SPOOL: bool = False
+    # Logging: level name, 'text' or 'json' lines, and records per minute of a sampled noisy path
+    LOG_LEVEL: str = 'INFO'
+    LOG_FORMAT: str = 'text'
+    LOG_SAMPLE_PER_MINUTE: int = 10
 
     @classmethod
     def from_dict(cls, env):
+        names = {f.name for f in fields(cls)}
         return cls(**{
-            k: v for k, v in env.items() if k in inspect.signature(cls).parameters
+            k: v for k, v in env.items() if k in names
         })
 
     def validate(self):
@@ -38,12 +66,111 @@ class AppConfig:
 
 
 def load_config():
-    with open('config.yaml', 'r', encoding='utf-8') as f:
+    with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
         config = yaml.safe_load(f)
         app_config_ = AppConfig.from_dict(config)
         app_config_.validate()
         return app_config_
 
 
-def app_config():
-    return load_config()
+_lock = threading.Lock()
+_snapshot: Optional[AppConfig] = None
+_snapshot_mtime: Optional[float] = None
+_next_check = 0.0
+_force_reload = False
+_reload_count = 0
+_reload_hooks: List[Callable[[AppConfig], None]] = []
+
+
+def _file_mtime() -> Optional[float]:
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def _reload(mtime: Optional[float]) -> Optional[AppConfig]:
+    """
+    Parse the config file and swap the snapshot in one assignment.
+    A broken file keeps the previous snapshot alive.
+
+    Returns:
+        Optional[AppConfig]: The new snapshot, None if the file could not be loaded.
+    """
+    global _snapshot, _snapshot_mtime, _reload_count
+    try:
+        new_config = load_config()
+    except Exception as e:
+        if _snapshot is None:
+            raise
+        logger.error(f"reload config failed, keep the old one: {e}")
+        _snapshot_mtime = mtime
+        return None
+    _snapshot = new_config
+    _snapshot_mtime = mtime
+    _reload_count += 1
+    return new_config
+
+
+def _run_hooks(config: AppConfig):
+    for hook in list(_reload_hooks):
+        try:
+            hook(config)
+        except Exception as e:
+            logger.error(f"config reload hook failed: {e}")
+
+
+def app_config() -> AppConfig:
+    """
+    Returns the process-wide config snapshot.
+
+    The file is parsed once and re-parsed only when its mtime changes
+    (checked at most every CONFIG_CHECK_INTERVAL seconds) or after SIGHUP.
+    """
+    global _next_check, _force_reload
+    now = time.monotonic()
+    if _snapshot is not None and not _force_reload and now < _next_check:
+        return _snapshot
+    reloaded = None
+    with _lock:
+        if _snapshot is None or _force_reload or now >= _next_check:
+            mtime = _file_mtime()
+            if _snapshot is None or _force_reload or mtime != _snapshot_mtime:
+                _force_reload = False
+                reloaded = _reload(mtime)
+            _next_check = now + CONFIG_CHECK_INTERVAL
+    # hooks run outside the lock, so they may call app_config() themselves
+    if reloaded is not None:
+        _run_hooks(reloaded)
+    return _snapshot
+
+
+def reload_config() -> AppConfig:
+    """ Force a reload on the next app_config() call and return the new snapshot """
+    global _force_reload
+    _force_reload = True
+    return app_config()
+
+
+def reload_count() -> int:
+    """ Number of times the config snapshot has been (re)loaded """
+    return _reload_count
+
+
+def add_reload_hook(hook: Callable[[AppConfig], None]):
+    """ Register a function called with the new config after every reload """
+    _reload_hooks.append(hook)
+
+
+def install_sighup_handler():
+    """
+    Reload the config on SIGHUP. Must be called from the main thread.
+    """
+    if not hasattr(signal, 'SIGHUP'):
+        return
+
+    def _on_sighup(signum, frame):
+        global _force_reload
+        _force_reload = True
+
+    signal.signal(signal.SIGHUP, _on_sighup)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    event de-duplication
+
+    Lark redelivers an event when /event does not answer in time. first_seen()
+    tells a new key from a retry so the same command is not run twice.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from lark_oapi import logger
+
+# Seconds a key is remembered; Lark retries within a few hours at most
+DEDUP_TTL = 6 * 3600
+# Max keys held in memory, oldest are evicted first
+DEDUP_MAX_KEYS = 100000
+# Purge expired SQLite keys every this many inserts
+DEDUP_PURGE_EVERY = 1000
+
+
+class Dedup:
+    def __init__(self, ttl: float = DEDUP_TTL, max_keys: int = DEDUP_MAX_KEYS, persistent: bool = False):
+        """
+        Args:
+            ttl (float): Seconds a key is remembered.
+            max_keys (int): Max keys kept in memory.
+            persistent (bool): Also record keys in SQLite so retries are caught after a restart.
+        """
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.persistent = persistent
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def first_seen(self, key: str) -> bool:
+        """
+        Record a key.
+
+        Returns:
+            bool: True the first time a key is seen within ttl, False for a duplicate.
+        """
+        if not key:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            expire_at = self._keys.get(key)
+            if expire_at is not None and expire_at > now:
+                self.hits += 1
+                return False
+            self._keys[key] = now + self.ttl
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        if self.persistent and not self._first_seen_db(key):
+            with self._lock:
+                self.hits += 1
+            return False
+        with self._lock:
+            self.misses += 1
+        return True
+
+    def _first_seen_db(self, key: str) -> bool:
+        import store.db_event as db_event
+        try:
+            inserted = db_event.insert_event_key(key, self.ttl)
+            self._inserts += 1
+            if self._inserts % DEDUP_PURGE_EVERY == 0:
+                db_event.delete_expired_event_keys()
+            return inserted
+        except Exception as e:
+            # fail open: running a retry twice beats dropping a new event
+            logger.error(f"dedup db failed: {e}")
+            return True
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._keys), "persistent": self.persistent}
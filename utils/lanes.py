@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    bounded work lanes
+
+    Each lane has its own worker threads and a bounded queue, so a burst of
+    slow work in one lane (GPT streams) never delays another (id, help).
+    When a lane is full the task is shed, or with the 'delay' policy the
+    submitter blocks up to delay_timeout seconds before shedding.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict
+
+from lark_oapi import logger
+
+import utils.log as log
+
+FAST = 'fast'
+CHAT = 'chat'
+ORDER = 'order'
+JOB = 'job'
+
+# name: (workers, max queue depth, policy, delay timeout in seconds)
+LANES = {
+    FAST: (4, 256, 'shed', 0),
+    CHAT: (8, 64, 'delay', 1.0),
+    ORDER: (2, 128, 'delay', 2.0),
+    JOB: (1, 1, 'shed', 0),
+}
+
+
+class Lane:
+    def __init__(self, name: str, workers: int, max_depth: int, policy: str = 'shed', delay_timeout: float = 0):
+        if policy not in ('shed', 'delay'):
+            raise ValueError(f"unknown lane policy: {policy}")
+        self.name = name
+        self.policy = policy
+        self.delay_timeout = delay_timeout
+        self.queue = queue.Queue(max_depth)
+        self._lock = threading.Lock()
+        self._stats = {
+            "submitted": 0, "shed": 0, "done": 0, "failed": 0,
+            "wait_total": 0.0, "wait_max": 0.0, "run_total": 0.0, "run_max": 0.0,
+        }
+        self._threads = [
+            threading.Thread(target=self._work, name=f"lane-{name}-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> bool:
+        """
+        Queue a task on this lane.
+
+        Returns:
+            bool: True if queued, False if the task was shed.
+        """
+        item = (time.monotonic(), fn, args, kwargs)
+        try:
+            if self.policy == 'delay':
+                self.queue.put(item, timeout=self.delay_timeout)
+            else:
+                self.queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self._stats["shed"] += 1
+            log.sampled(f"shed:{self.name}", logging.WARNING, "lane %s is full, shed %s",
+                        self.name, getattr(fn, '__name__', fn))
+            return False
+        with self._lock:
+            self._stats["submitted"] += 1
+        return True
+
+    def room(self) -> int:
+        """ Tasks that can be queued right now without waiting or shedding """
+        return max(0, self.queue.maxsize - self.queue.qsize())
+
+    def _work(self):
+        while True:
+            enqueued, fn, args, kwargs = self.queue.get()
+            start = time.monotonic()
+            ok = True
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                ok = False
+                logger.error(f"lane {self.name} task {getattr(fn, '__name__', fn)} failed: {e}")
+            end = time.monotonic()
+            wait, run = start - enqueued, end - start
+            with self._lock:
+                self._stats["done" if ok else "failed"] += 1
+                self._stats["wait_total"] += wait
+                self._stats["wait_max"] = max(self._stats["wait_max"], wait)
+                self._stats["run_total"] += run
+                self._stats["run_max"] = max(self._stats["run_max"], run)
+            self.queue.task_done()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        finished = stats["done"] + stats["failed"]
+        stats["depth"] = self.queue.qsize()
+        stats["wait_avg"] = stats["wait_total"] / finished if finished else 0.0
+        stats["run_avg"] = stats["run_total"] / finished if finished else 0.0
+        return stats
+
+
+_lanes: Dict[str, Lane] = {}
+_lanes_lock = threading.Lock()
+
+
+def get_lane(name: str) -> Lane:
+    lane = _lanes.get(name)
+    if lane is not None:
+        return lane
+    with _lanes_lock:
+        if name not in _lanes:
+            workers, max_depth, policy, delay_timeout = LANES[name]
+            _lanes[name] = Lane(name, workers, max_depth, policy, delay_timeout)
+        return _lanes[name]
+
+
+def submit(name: str, fn: Callable, *args, **kwargs) -> bool:
+    """ Queue fn(*args, **kwargs) on the named lane, see Lane.submit """
+    return get_lane(name).submit(fn, *args, **kwargs)
+
+
+def stats() -> dict:
+    """ Queue depth, shed count, queue-wait and run time per lane """
+    return {name: lane.stats() for name, lane in list(_lanes.items())}
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    leader election between worker processes
+
+    Workers of one host race for an exclusive lock on a file; the holder is
+    the leader and runs the singleton jobs (the work order sweep). The kernel
+    drops the lock when the leader dies, and a standby takes over at its
+    next attempt.
+"""
+import fcntl
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from lark_oapi import logger
+
+LEADER_LOCK_FILE = '/tmp/lark-robot-leader.lock'
+# Seconds between two attempts of a standby to take the lock
+LEADER_RETRY_INTERVAL = 10.0
+
+
+class FileLease:
+    def __init__(self, path: str = LEADER_LOCK_FILE):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        """
+        Take the lock without waiting.
+
+        Returns:
+            bool: True if this process holds the lock.
+        """
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+_lease = FileLease()
+
+
+def is_leader() -> bool:
+    return _lease.held
+
+
+def run_when_leader(on_elected: Callable[[], None], interval: float = LEADER_RETRY_INTERVAL) -> threading.Thread:
+    """
+    Call on_elected once, as soon as this process becomes the leader.
+
+    Args:
+        on_elected (Callable[[], None]): Starts the singleton jobs.
+        interval (float): Seconds between two attempts while on standby.
+
+    Returns:
+        threading.Thread: The daemon thread waiting for the lock.
+    """
+    def campaign():
+        while not _lease.try_acquire():
+            time.sleep(interval)
+        logger.info(f"process {os.getpid()} is the leader")
+        on_elected()
+
+    thread = threading.Thread(target=campaign, name="leader", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    logging setup
+
+    The level and format of the Lark logger come from LOG_LEVEL and
+    LOG_FORMAT and follow config reloads. Payloads are serialized lazily,
+    only when a record is actually emitted, and noisy categories are
+    sampled to LOG_SAMPLE_PER_MINUTE records, with a count of the rest.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+import lark_oapi as lark
+from lark_oapi import logger
+
+from utils.config import AppConfig, app_config, add_reload_hook
+
+# Seconds of one sampling window
+SAMPLE_WINDOW = 60.0
+
+_TEXT_FORMAT = "[Lark] [%(asctime)s] [%(levelname)s] %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line, for log shippers """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        category = getattr(record, "category", None)
+        if category:
+            entry["category"] = category
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class Lazy:
+    """ Defers fn(*args) to the moment a record using it as a %s argument is formatted """
+
+    def __init__(self, fn: Callable[..., Any], *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self) -> str:
+        return str(self.fn(*self.args))
+
+
+def lazy_json(obj: Any) -> Lazy:
+    """ obj as Lark JSON, serialized only if the record is emitted """
+    return Lazy(lark.JSON.marshal, obj)
+
+
+def _parse_level(name: str) -> int:
+    value = logging.getLevelName(str(name).upper())
+    return value if isinstance(value, int) else logging.WARNING
+
+
+def level() -> int:
+    """ The configured logging level, WARNING if LOG_LEVEL is unknown """
+    return _parse_level(app_config().LOG_LEVEL)
+
+
+def lark_level() -> lark.LogLevel:
+    """
+    The configured level for lark_oapi builders, which set the logger level themselves.
+    lark.LogLevel only has the five named levels, others (e.g. NOTSET, 0) go to the
+    nearest one below, DEBUG at the least.
+    """
+    value = level()
+    below = [member for member in lark.LogLevel if member.value <= value]
+    return max(below, key=lambda member: member.value) if below else lark.LogLevel.DEBUG
+
+
+def _apply(config: AppConfig):
+    logger.setLevel(_parse_level(config.LOG_LEVEL))
+    formatter = JsonFormatter() if config.LOG_FORMAT == "json" else logging.Formatter(_TEXT_FORMAT)
+    for handler in logger.handlers:
+        handler.setFormatter(formatter)
+
+
+add_reload_hook(_apply)
+_apply(app_config())
+
+
+class _Sampler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # category: [window start, records emitted, records suppressed]
+        self._windows: Dict[str, List] = {}
+        self.suppressed: Dict[str, int] = {}
+
+    def admit(self, category: str, per_window: int) -> int:
+        """
+        Returns:
+            int: -1 to drop the record, else the records suppressed since the last one emitted.
+        """
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(category)
+            if window is None or now - window[0] >= SAMPLE_WINDOW:
+                skipped = window[2] if window is not None else 0
+                self._windows[category] = [now, 1, 0]
+                return skipped
+            if window[1] < per_window:
+                window[1] += 1
+                return 0
+            window[2] += 1
+            self.suppressed[category] = self.suppressed.get(category, 0) + 1
+            return -1
+
+
+_sampler = _Sampler()
+
+
+def sampled(category: str, lvl: int, msg: str, *args):
+    """
+    Log at most LOG_SAMPLE_PER_MINUTE records of a category per window;
+    the next emitted record tells how many were dropped.
+
+    Args:
+        category (str): The noisy path, e.g. 'not_for_robot'.
+        lvl (int): The logging level.
+        msg (str): The message, %-style with args, formatted only if emitted.
+    """
+    if not logger.isEnabledFor(lvl):
+        return
+    skipped = _sampler.admit(category, app_config().LOG_SAMPLE_PER_MINUTE)
+    if skipped < 0:
+        return
+    if skipped:
+        msg += f" ({skipped} similar suppressed)"
+    logger.log(lvl, msg, *args, extra={"category": category})
+
+
+def stats() -> dict:
+    """ Records suppressed by sampling, per category """
+    return dict(_sampler.suppressed)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    pooled OpenAI clients
+
+    CHAT_KEY is a comma-separated list of keys. One long-lived client is kept
+    per key (each holds its own keep-alive connections), requests go
+    round-robin over the keys, a key that gets a 429 cools down for the
+    Retry-After period, and a failed request fails over to the next key.
+"""
+import itertools
+import threading
+import time
+from typing import List, Optional
+
+import openai
+from openai import OpenAI
+from lark_oapi import logger
+
+from utils.config import app_config, add_reload_hook
+
+# Cooldown of a rate limited key when the response has no Retry-After, in seconds
+COOLDOWN_DEFAULT = 20
+# Longest wait for a key to leave cooldown when all keys are cooling down
+COOLDOWN_MAX_WAIT = 10
+# Errors that are worth retrying on another key
+FAILOVER_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class KeySlot:
+    def __init__(self, key: str, base_url: Optional[str]):
+        self.key = key
+        self.client = OpenAI(api_key=key, base_url=base_url, max_retries=0)
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "errors": self.errors,
+            "cooldown": max(0.0, round(self.cooldown_until - time.monotonic(), 1)),
+        }
+
+
+class OpenAIPool:
+    def __init__(self, keys: List[str], base_url: Optional[str] = None):
+        if not keys:
+            raise ValueError("CHAT_KEY is required")
+        self.keys = keys
+        self.base_url = base_url
+        self.slots = [KeySlot(key, base_url) for key in keys]
+        self._next = itertools.cycle(range(len(self.slots)))
+        self._lock = threading.Lock()
+
+    def _pick(self, tried: set) -> Optional[KeySlot]:
+        """ Next key in round-robin order that is not cooling down and not yet tried """
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.slots)):
+                slot = self.slots[next(self._next)]
+                if slot.cooldown_until <= now and id(slot) not in tried:
+                    return slot
+        return None
+
+    def _wait_for_slot(self, tried: set) -> Optional[KeySlot]:
+        waiting = [s.cooldown_until for s in self.slots if id(s) not in tried]
+        if not waiting:
+            return None
+        wait = min(waiting) - time.monotonic()
+        if wait > COOLDOWN_MAX_WAIT:
+            return None
+        if wait > 0:
+            time.sleep(wait)
+        return self._pick(tried)
+
+    def create(self, **kwargs):
+        """
+        chat.completions.create() on the next available key, failing over
+        to the other keys on rate limit, connection or server errors.
+        """
+        tried = set()
+        last_error = None
+        while True:
+            slot = self._pick(tried) or self._wait_for_slot(tried)
+            if slot is None:
+                if last_error is not None:
+                    raise last_error
+                raise RuntimeError("all chat keys are cooling down")
+            tried.add(id(slot))
+            slot.requests += 1
+            try:
+                return slot.client.chat.completions.create(**kwargs)
+            except openai.RateLimitError as e:
+                slot.rate_limited += 1
+                slot.cooldown_until = time.monotonic() + _retry_after(e)
+                logger.warning(f"chat key ...{slot.key[-4:]} rate limited, cooling down")
+                last_error = e
+            except FAILOVER_ERRORS as e:
+                slot.errors += 1
+                logger.warning(f"chat key ...{slot.key[-4:]} failed: {e}")
+                last_error = e
+
+    def stats(self) -> dict:
+        return {f"...{slot.key[-4:]}": slot.stats() for slot in self.slots}
+
+
+def _retry_after(error: openai.RateLimitError) -> float:
+    try:
+        return float(error.response.headers.get("retry-after", COOLDOWN_DEFAULT))
+    except (AttributeError, TypeError, ValueError):
+        return COOLDOWN_DEFAULT
+
+
+_pool: Optional[OpenAIPool] = None
+_pool_lock = threading.Lock()
+
+
+def _parse_keys(chat_key: str) -> List[str]:
+    return [key.strip() for key in (chat_key or "").split(",") if key.strip()]
+
+
+def get_pool() -> OpenAIPool:
+    """ Returns the process-wide pool, built from CHAT_KEY on first use """
+    global _pool
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            config = app_config()
+            _pool = OpenAIPool(_parse_keys(config.CHAT_KEY), config.CHAT_BASE_URL)
+        return _pool
+
+
+def stats() -> dict:
+    return _pool.stats() if _pool is not None else {}
+
+
+def _on_config_reload(config):
+    global _pool
+    pool = _pool
+    if pool is None:
+        return
+    if pool.keys != _parse_keys(config.CHAT_KEY) or pool.base_url != config.CHAT_BASE_URL:
+        with _pool_lock:
+            _pool = None
+
+
+add_reload_hook(_on_config_reload)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    local stub of the OpenAI chat completions api
+
+    python -m utils.openai_stub [--port 7799]
+    then set CHAT_BASE_URL: http://127.0.0.1:7799/v1 in config.yaml.
+
+    The answer echoes the last user message. A key starting with "429"
+    always gets a rate limit error with Retry-After, a key starting with
+    "500" a server error, so key failover can be exercised locally.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds between two streamed chunks
+CHUNK_DELAY = 0.02
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        key = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        if key.startswith("429"):
+            self._send_json(429, {"error": {"message": "rate limited", "type": "requests"}}, {"Retry-After": "1"})
+            return
+        if key.startswith("500"):
+            self._send_json(500, {"error": {"message": "server error"}})
+            return
+
+        messages = body.get("messages", [])
+        answer = f"echo: {messages[-1]['content'] if messages else ''}"
+        model = body.get("model", "stub")
+        if not body.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": answer}}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for word in answer.split(" "):
+            self._send_chunk(model, {"content": word + " "}, None)
+            time.sleep(CHUNK_DELAY)
+        self._send_chunk(model, {}, "stop")
+        self._write("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_chunk(self, model: str, delta: dict, finish_reason):
+        chunk = {
+            "id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        self._write(f"data: {json.dumps(chunk)}\n\n")
+
+    def _write(self, text: str):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    """ Returns a started-up server; call serve_forever() or run it in a thread """
+    return ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=7799, type=int, help='port number')
+    args = parser.parse_args()
+    serve(args.port).serve_forever()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    coalescing card patcher
+
+    A streaming answer produces text much faster than a card can be patched.
+    CardPatcher patches from its own thread, always with the latest text,
+    so intermediate states are dropped and the producer never waits on Lark.
+"""
+import threading
+import time
+from typing import Callable, Optional, Union
+
+from lark_oapi import logger
+
+import utils.robot as robot
+
+# Bounds of the interval between two patches of one card, in seconds
+PATCH_MIN_INTERVAL = 0.3
+PATCH_MAX_INTERVAL = 5.0
+# The interval follows this multiple of the observed patch latency
+PATCH_LATENCY_FACTOR = 2.0
+# Attempts to deliver the final state
+PATCH_FINAL_RETRIES = 5
+
+
+class CardPatcher:
+    def __init__(self, message_id: str, render: Callable[[str], Union[str, dict]]):
+        """
+        Args:
+            message_id (str): The ID of the card message to patch.
+            render (Callable[[str], Union[str, dict]]): Builds the intermediate card from the text so far,
+                e.g. lark.card.markdown, which returns the card serialized.
+        """
+        self.message_id = message_id
+        self.render = render
+        self.interval = PATCH_MIN_INTERVAL
+        self.patches = 0
+        self.failures = 0
+        self._text: Optional[str] = None
+        self._final: Optional[Union[str, dict]] = None
+        self._closed = False
+        self._delivered = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name=f"patcher-{message_id}", daemon=True)
+        self._thread.start()
+
+    def update(self, text: str):
+        """ Replace the pending text; never blocks on I/O """
+        with self._cond:
+            self._text = text
+            self._cond.notify()
+
+    def close(self, final: Union[str, dict], timeout: float = None) -> bool:
+        """
+        Deliver the final card and stop the patcher.
+
+        Args:
+            final (Union[str, dict]): The final card content, serialized or not.
+            timeout (float): Max seconds to wait for delivery, forever if None.
+
+        Returns:
+            bool: True if the final card was delivered.
+        """
+        with self._cond:
+            self._final = final
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout)
+        return self._delivered
+
+    def _patch(self, content: Union[str, dict]) -> bool:
+        start = time.monotonic()
+        try:
+            ok = robot.refresh_card(self.message_id, content)
+        except Exception as e:
+            # e.g. the limiter gave up on a connection error: a failed patch, the thread must live on
+            logger.warning(f"patch of card {self.message_id} failed: {e}")
+            ok = False
+        latency = time.monotonic() - start
+        self.patches += 1
+        if ok:
+            # track latency: a slow Lark means fewer, larger patches
+            self.interval = max(PATCH_MIN_INTERVAL, min(PATCH_MAX_INTERVAL, latency * PATCH_LATENCY_FACTOR))
+        else:
+            # most likely throttled, back off
+            self.failures += 1
+            self.interval = min(PATCH_MAX_INTERVAL, self.interval * 2)
+        return ok
+
+    def _run(self):
+        next_at = 0.0
+        while True:
+            with self._cond:
+                while self._text is None and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    break
+                text, self._text = self._text, None
+            wait = next_at - time.monotonic()
+            if wait > 0:
+                # more text may arrive meanwhile, only the latest is patched
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, wait)
+                    if self._closed:
+                        break
+                    if self._text is not None:
+                        text, self._text = self._text, None
+            self._patch(self.render(text))
+            next_at = time.monotonic() + self.interval
+
+        for attempt in range(PATCH_FINAL_RETRIES):
+            wait = next_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if self._patch(self._final):
+                self._delivered = True
+                return
+            next_at = time.monotonic() + self.interval
+        logger.error(f"final patch of card {self.message_id} not delivered after {PATCH_FINAL_RETRIES} attempts")
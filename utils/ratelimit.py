@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    Lark api rate limiter
+
+    Every call waits for a token of its endpoint's bucket and, for message
+    apis, of the target chat's bucket, so bursts are spread to the quota
+    instead of bouncing off it. Calls answered with a rate limit or transient
+    error are retried with jittered exponential backoff, and the number of
+    calls in flight follows AIMD: +1 per success window, halved on throttling.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+import requests
+from lark_oapi import logger
+
+import utils.log as log
+
+# Calls per second and burst of each endpoint, after Lark's documented tiers
+# (1000/min with bursts of 50/s for most apis, 5/s per chat or per message)
+ENDPOINT_QUOTAS: Dict[str, Tuple[float, int]] = {
+    "message.create": (50, 50),
+    "message.reply": (50, 50),
+    "message.patch": (50, 50),
+    "message.list": (1000 / 60, 50),
+    "chat.create": (1000 / 60, 20),
+    "chat.get": (1000 / 60, 50),
+    "chat.update": (1000 / 60, 20),
+    "chat.delete": (1000 / 60, 20),
+    "chat.list": (1000 / 60, 50),
+    "chat_members.get": (1000 / 60, 50),
+    "bot.info": (1000 / 60, 50),
+}
+DEFAULT_QUOTA = (1000 / 60, 50)
+# Calls per second and burst to one chat, or patches to one message
+CHAT_QUOTA = (5, 5)
+# Max per-chat buckets kept, least recently used dropped first
+CHAT_BUCKETS_MAX = 4096
+
+# Lark codes meaning "slow down": app frequency limit and message rate limits
+RATE_LIMIT_CODES = {99991400, 11232, 11233, 230020}
+# Lark codes worth retrying as is: internal errors
+TRANSIENT_CODES = {1000004, 1000005, 55001}
+# Attempts after the first and backoff bounds of retryable failures, in seconds
+RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10.0
+
+# Bounds and start of the AIMD limit on calls in flight
+CONCURRENCY_MIN = 2
+CONCURRENCY_MAX = 64
+CONCURRENCY_START = 16
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """
+        Args:
+            rate (float): Tokens added per second.
+            burst (int): Max tokens held.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token, going into debt if there is none.
+
+        Returns:
+            float: Seconds to wait before the token may be used.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class AIMDLimit:
+    def __init__(self, start: int = CONCURRENCY_START, low: int = CONCURRENCY_MIN, high: int = CONCURRENCY_MAX):
+        self.limit = start
+        self.low = low
+        self.high = high
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+        # futures of coroutines waiting in aacquire, with their loops
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def aacquire(self):
+        """ Same as acquire, parking the coroutine on a future instead of blocking the loop """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, throttled: bool = False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.low, self.limit // 2)
+                self._successes = 0
+            else:
+                # one more slot per limit-sized window of successes
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    self.limit = min(self.high, self.limit + 1)
+            self._cond.notify_all()
+            waiters, self._waiters = self._waiters, []
+        # release may run on any thread, a future is only touched on its own loop
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # the loop is closed, nobody is waiting on it any more
+                pass
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _retry_after(response) -> float:
+    """ Seconds until the quota resets, from Lark's x-ogw-ratelimit-reset header """
+    headers = response.raw.headers if response.raw is not None and response.raw.headers else {}
+    for name, value in headers.items():
+        if name.lower() == "x-ogw-ratelimit-reset":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 0.0
+
+
+def classify(response) -> Optional[str]:
+    """
+    Returns:
+        Optional[str]: 'throttled' or 'transient' if the call should be retried, else None.
+    """
+    if response.code in RATE_LIMIT_CODES or (response.raw is not None and response.raw.status_code == 429):
+        return "throttled"
+    if response.code in TRANSIENT_CODES or (response.raw is not None and (response.raw.status_code or 0) >= 500):
+        return "transient"
+    return None
+
+
+def backoff(attempt: int, floor: float = 0.0) -> float:
+    """ Full-jitter exponential backoff, at least floor seconds """
+    return max(floor, random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+
+class Limiter:
+    def __init__(self):
+        self.concurrency = AIMDLimit()
+        self._endpoints: Dict[str, TokenBucket] = {}
+        self._chats: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def _bucket(self, endpoint: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._endpoints.get(endpoint)
+            if bucket is None:
+                bucket = self._endpoints[endpoint] = TokenBucket(*ENDPOINT_QUOTAS.get(endpoint, DEFAULT_QUOTA))
+            return bucket
+
+    def _chat_bucket(self, key: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._chats.get(key)
+            if bucket is None:
+                bucket = self._chats[key] = TokenBucket(*CHAT_QUOTA)
+                if len(self._chats) > CHAT_BUCKETS_MAX:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(key)
+            return bucket
+
+    def reserve(self, endpoint: str, key: str = None) -> float:
+        """ Seconds to wait for a token of the endpoint and, if given, of the chat """
+        wait = self._bucket(endpoint).reserve()
+        if key:
+            wait = max(wait, self._chat_bucket(key).reserve())
+        return wait
+
+    def _outcome(self, endpoint: str, response, attempt: int) -> Optional[float]:
+        """ Returns the seconds to back off before a retry, or None if the response is final """
+        kind = classify(response)
+        if kind is None:
+            return None
+        if kind == "throttled":
+            self.throttled += 1
+        if attempt >= RETRIES:
+            self.failed += 1
+            return None
+        self.retries += 1
+        wait = backoff(attempt, _retry_after(response))
+        log.sampled(f"retry:{endpoint}", logging.WARNING, "%s %s, code: %s, retry %d in %.2fs",
+                    endpoint, kind, response.code, attempt + 1, wait)
+        return wait
+
+    def call(self, endpoint: str, key: Optional[str], fn: Callable):
+        """
+        Run fn() under the endpoint and chat quotas, retrying retryable failures.
+
+        Args:
+            endpoint (str): The Lark api, a key of ENDPOINT_QUOTAS.
+            key (str): The chat or message the call targets, None if not chat-scoped.
+            fn (Callable): Makes the call and returns the lark_oapi response.
+
+        Returns:
+            The last response.
+        """
+        attempt = 0
+        while True:
+            time.sleep(self.reserve(endpoint, key))
+            self.concurrency.acquire()
+            self.calls += 1
+            response = None
+            try:
+                response = fn()
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= RETRIES:
+                    self.failed += 1
+                    raise
+                logger.warning(f"{endpoint} failed: {e}, retry {attempt + 1}")
+                self.retries += 1
+            finally:
+                self.concurrency.release(response is not None and classify(response) == "throttled")
+            wait = self._outcome(endpoint, response, attempt) if response is not None else backoff(attempt)
+            if wait is None:
+                return response
+            time.sleep(wait)
+            attempt += 1
+
+    async def acall(self, endpoint: str, key: Optional[str], fn: Callable):
+        """ Same as call, for fn returning an awaitable, without blocking the event loop """
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.reserve(endpoint, key))
+            await self.concurrency.aacquire()
+            self.calls += 1
+            response = None
+            try:
+                response = await fn()
+            except (requests.ConnectionError, requests.Timeout, httpx.TransportError) as e:
+                if attempt >= RETRIES:
+                    self.failed += 1
+                    raise
+                logger.warning(f"{endpoint} failed: {e}, retry {attempt + 1}")
+                self.retries += 1
+            finally:
+                self.concurrency.release(response is not None and classify(response) == "throttled")
+            wait = self._outcome(endpoint, response, attempt) if response is not None else backoff(attempt)
+            if wait is None:
+                return response
+            await asyncio.sleep(wait)
+            attempt += 1
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls, "retries": self.retries, "throttled": self.throttled, "failed": self.failed,
+            "concurrency": self.concurrency.limit, "in_flight": self.concurrency.in_flight,
+            "chats": len(self._chats),
+        }
+
+
+_limiter = Limiter()
+
+
+def call(endpoint: str, key: Optional[str], fn: Callable):
+    """ Run a Lark api call under the shared limiter, see Limiter.call """
+    return _limiter.call(endpoint, key, fn)
+
+
+async def acall(endpoint: str, key: Optional[str], fn: Callable):
+    """ Await a Lark api call under the shared limiter, see Limiter.acall """
+    return await _limiter.acall(endpoint, key, fn)
+
+
+def stats() -> dict:
+    return _limiter.stats()
@@ -5,9 +5,11 @@
 """
 import os
 import json
+import threading
 import uuid
 
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import lark_oapi as lark
 from lark_oapi import logger
@@ -17,41 +19,83 @@ from lark_oapi.api.im.v1 import (
     ReplyMessageRequest, ReplyMessageRequestBody, ReplyMessageResponse, ReplyMessageResponseBody,
     CreateChatRequest, CreateChatRequestBody, CreateChatResponse,
     CreateChatResponseBody, DeleteChatRequest, DeleteChatResponse, UpdateChatRequest,
-    ListChat, ListChatRequest, ListChatResponse, UpdateChatRequestBody, UpdateChatResponse,
+    ListChat, ListChatRequest, UpdateChatRequestBody, UpdateChatResponse,
     PatchMessageRequest, PatchMessageRequestBody, PatchMessageResponse, GetChatRequest, GetChatResponse,
-    GetChatResponseBody, ListMessageRequest, ListMessageResponse, Message, GetChatMembersRequest,
-    GetChatMembersResponse, ListMember
+    GetChatResponseBody, ListMessageRequest, Message, GetChatMembersRequest, ListMember
 )
 
-from utils.config import app_config
+import utils.client as client
+import utils.ratelimit as ratelimit
+from utils.cache import TTLCache
 
 APP_ID = os.environ.get('APP_ID', '123456')
 APP_SECRET = os.environ.get('APP_SECRET', '123456')
 
+# Items per page for the paginated list apis
+PAGE_SIZE = 100
+
+# Fetches the next page while the caller consumes the current one
+__prefetch_executor = ThreadPoolExecutor(4, thread_name_prefix="robot-prefetch")
+
+# Seconds a group member index stays cached, and max groups cached
+MEMBER_CACHE_TTL = 600
+MEMBER_CACHE_SIZE = 1024
+
+__member_cache = TTLCache(MEMBER_CACHE_TTL, MEMBER_CACHE_SIZE)
+
+# Seconds the (name, chat_id) index of the robot's groups stays cached
+GROUP_INDEX_TTL = 300
+
+__group_index_cache = TTLCache(GROUP_INDEX_TTL, 1)
+
+# The robot's own info is cached for a day, a failed fetch is retried after a minute
+BOT_INFO_TTL = 24 * 3600
+BOT_INFO_RETRY = 60
+
+__bot_info_cache = TTLCache(BOT_INFO_TTL, 1)
+__bot_info_lock = threading.Lock()
+__bot_info_resolving = False
+
+# Chat of recently received messages, so replies count against their chat's rate limit
+MESSAGE_CHAT_TTL = 3600
+MESSAGE_CHAT_SIZE = 4096
+__message_chat_cache = TTLCache(MESSAGE_CHAT_TTL, MESSAGE_CHAT_SIZE)
+
+
+class PageError(Exception):
+    """ A page of a list api failed, the items seen so far are incomplete """
+
 
 def __create_client():
     """
-    Creates and configures a new Lark client.
+    Returns the shared Lark client.
 
     Returns:
-        The configured Lark client.
+        The process-wide Lark client, see utils.client.
     """
-    client = lark.Client.builder() \
-        .app_id(app_config().APP_ID) \
-        .app_secret(app_config().APP_SECRET) \
-        .log_level(lark.LogLevel.DEBUG) \
-        .build()
-    return client
+    return client.get_client()
+
 
+def stats() -> dict:
+    """ Shared client, tenant token, rate limiter and cache counters """
+    return dict(client.stats(), ratelimit=ratelimit.stats(), member_cache=__member_cache.stats(),
+                group_index_cache=__group_index_cache.stats())
 
-def __send_msg(id_type: str = 'user_id', id_to: str = None, content: dict = None, msg_type: str = 'text') -> bool:
+
+def content_json(content) -> str:
+    """ Message content as JSON; content already serialized (see lark.card.CardTemplate) is passed as is """
+    return content if isinstance(content, str) else json.dumps(content)
+
+
+def __send_msg(id_type: str = 'user_id', id_to: str = None, content: Union[str, dict] = None,
+               msg_type: str = 'text') -> bool:
     """
     Send a message.
 
     Args:
         id_type (str): The type of ID to send the message to. Defaults to 'user_id'.
         id_to (str): The ID of the recipient.
-        content (dict): The content of the message.
+        content (Union[str, dict]): The content of the message, serialized or not.
         msg_type (str): The type of the message. Defaults to 'text'.
 
     Returns:
@@ -65,13 +109,15 @@ def __send_msg(id_type: str = 'user_id', id_to: str = None, content: dict = None
         .receive_id_type(id_type) \
         .request_body(CreateMessageRequestBody.builder()
                       .receive_id(id_to)
-                      .content(json.dumps(content))
+                      .content(content_json(content))
                       .msg_type(msg_type)
                       .uuid(str(uuid.uuid4()))
                       .build()).build()
 
     # Send the message
-    response = cli.im.v1.message.create(request)
+    response = ratelimit.call(
+        "message.create", id_to, lambda: cli.im.v1.message.create(request, client.request_option())
+    )
 
     # Check if the message was sent successfully
     if not response.success():
@@ -86,20 +132,32 @@ def send_text(id_type: str = 'user_id', id_to: str = None, message: str = None)
     return __send_msg(id_type, id_to, content_dict)
 
 
-def send_rich(id_type: str = 'user_id', id_to: str = None, content: dict = None) -> bool:
+def send_rich(id_type: str = 'user_id', id_to: str = None, content: Union[str, dict] = None) -> bool:
     return __send_msg(id_type, id_to, content, 'post')
 
 
-def send_card(id_type: str = 'user_id', id_to: str = None, content: dict = None) -> bool:
+def send_card(id_type: str = 'user_id', id_to: str = None, content: Union[str, dict] = None) -> bool:
     return __send_msg(id_type, id_to, content, msg_type='interactive')
 
 
-def __reply_msg(msg_id: str, content: dict = None, msg_type: str = 'text') -> ReplyMessageResponseBody:
+def remember_chat(msg_id: str, chat_id: str):
+    """ Record the chat of a received message, see reply_key """
+    if msg_id and chat_id:
+        __message_chat_cache.set(msg_id, chat_id)
+
+
+def reply_key(msg_id: str) -> str:
+    """ The rate limit key of a reply: the chat of the message if known, else the message """
+    return __message_chat_cache.get(msg_id) or msg_id
+
+
+def __reply_msg(msg_id: str, content: Union[str, dict] = None, msg_type: str = 'text') -> ReplyMessageResponseBody:
     """
     Reply to a message.
     Args:
         msg_id (str): The ID of the message to reply to.
-        content (dict, optional): The content of the reply message. Defaults to None.
+        content (Union[str, dict], optional): The content of the reply message, serialized or not.
+            Defaults to None.
         msg_type (str, optional): The type of the reply message. Defaults to 'text'.
     Returns:
         bool: True if the reply is successful, False otherwise.
@@ -110,11 +168,13 @@ def __reply_msg(msg_id: str, content: dict = None, msg_type: str = 'text') -> Re
     request: ReplyMessageRequest = ReplyMessageRequest.builder() \
         .message_id(msg_id) \
         .request_body(ReplyMessageRequestBody.builder()
-                      .content(json.dumps(content))
+                      .content(content_json(content))
                       .msg_type(msg_type)
                       .uuid(str(uuid.uuid4()))
                       .build()).build()
-    response: ReplyMessageResponse = cli.im.v1.message.reply(request)
+    response: ReplyMessageResponse = ratelimit.call(
+        "message.reply", reply_key(msg_id), lambda: cli.im.v1.message.reply(request, client.request_option())
+    )
     if not response.success():
         logger.error(f"reply msg failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
     return response.data
@@ -125,21 +185,21 @@ def reply_text(msg_id: str, message: str = None) -> ReplyMessageResponseBody:
     return __reply_msg(msg_id, content_dict)
 
 
-def reply_rich(msg_id: str, content: dict = None) -> ReplyMessageResponseBody:
+def reply_rich(msg_id: str, content: Union[str, dict] = None) -> ReplyMessageResponseBody:
     return __reply_msg(msg_id, content, msg_type='post')
 
 
-def reply_card(msg_id: str, content: dict = None) -> ReplyMessageResponseBody:
+def reply_card(msg_id: str, content: Union[str, dict] = None) -> ReplyMessageResponseBody:
     return __reply_msg(msg_id, content, msg_type='interactive')
 
 
-def refresh_card(id_to: str = None, content: dict = None) -> bool:
+def refresh_card(id_to: str = None, content: Union[str, dict] = None) -> bool:
     """
     Refreshes a card message.
 
     Args:
         id_to (str): The ID of the message to refresh.
-        content (dict): The updated content of the message.
+        content (Union[str, dict]): The updated content of the message, serialized or not.
 
     Returns:
         bool: True if the message was successfully refreshed, False otherwise.
@@ -151,11 +211,13 @@ def refresh_card(id_to: str = None, content: dict = None) -> bool:
     request: PatchMessageRequest = PatchMessageRequest.builder() \
         .message_id(id_to) \
         .request_body(PatchMessageRequestBody.builder()
-                      .content(json.dumps(content))
+                      .content(content_json(content))
                       .build()).build()
 
     # Send the patch request
-    response: PatchMessageResponse = cli.im.v1.message.patch(request)
+    response: PatchMessageResponse = ratelimit.call(
+        "message.patch", id_to, lambda: cli.im.v1.message.patch(request, client.request_option())
+    )
 
     # Check if the response was successful
     if not response.success():
@@ -167,24 +229,9 @@ def refresh_card(id_to: str = None, content: dict = None) -> bool:
     return True
 
 
-def create_group(chat_name: str, id_list: list, chat_description: str) -> CreateChatResponseBody:
-    """
-    Create a group chat.
-
-    Args:
-        chat_name (str): The name of the chat.
-        id_list (list): A list of user IDs to add to the chat.
-        chat_description (str): The description of the chat.
-
-    Returns:
-        CreateChatResponseBody: The response body of the create chat API.
-
-    """
-    # Create a client
-    cli = __create_client()
-
-    # Build the request object
-    request: CreateChatRequest = (
+def create_group_request(chat_name: str, id_list: list, chat_description: str) -> CreateChatRequest:
+    """ A private group chat managed by the robot, shared with utils.arobot """
+    return (
         CreateChatRequest.builder()
         .uuid(str(uuid.uuid4()))
         .user_id_type('user_id')
@@ -205,14 +252,50 @@ def create_group(chat_name: str, id_list: list, chat_description: str) -> Create
         .build()
     )
 
+
+def delete_group_request(chat_id: str) -> DeleteChatRequest:
+    return DeleteChatRequest.builder().chat_id(chat_id).build()
+
+
+def update_group_name_request(chat_id: str, chat_name: str) -> UpdateChatRequest:
+    return UpdateChatRequest.builder() \
+        .chat_id(chat_id) \
+        .user_id_type('user_id') \
+        .request_body(UpdateChatRequestBody.builder()
+                      .name(chat_name).build()).build()
+
+
+def create_group(chat_name: str, id_list: list, chat_description: str) -> CreateChatResponseBody:
+    """
+    Create a group chat.
+
+    Args:
+        chat_name (str): The name of the chat.
+        id_list (list): A list of user IDs to add to the chat.
+        chat_description (str): The description of the chat.
+
+    Returns:
+        CreateChatResponseBody: The response body of the create chat API.
+
+    """
+    # Create a client
+    cli = __create_client()
+
+    # Build the request object
+    request: CreateChatRequest = create_group_request(chat_name, id_list, chat_description)
+
     # Make the API request
-    response: CreateChatResponse = cli.im.v1.chat.create(request)
+    response: CreateChatResponse = ratelimit.call(
+        "chat.create", None, lambda: cli.im.v1.chat.create(request, client.request_option())
+    )
 
     # Log an error if the API call was not successful
     if not response.success():
         logger.error(
             f"create group failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
         )
+    else:
+        invalidate_group_index()
 
     # Return the response data
     return response.data
@@ -235,7 +318,9 @@ def get_group_info(chat_id: str) -> GetChatResponseBody:
     request: GetChatRequest = GetChatRequest.builder().chat_id(chat_id).user_id_type('user_id').build()
 
     # Send the get chat request
-    response: GetChatResponse = cli.im.v1.chat.get(request)
+    response: GetChatResponse = ratelimit.call(
+        "chat.get", None, lambda: cli.im.v1.chat.get(request, client.request_option())
+    )
 
     # Check if the get chat request was successful
     if not response.success():
@@ -261,10 +346,12 @@ def delete_group(chat_id: str) -> bool:
     cli = __create_client()
 
     # Create a delete chat request
-    request: DeleteChatRequest = DeleteChatRequest.builder().chat_id(chat_id).build()
+    request: DeleteChatRequest = delete_group_request(chat_id)
 
     # Send the delete chat request
-    response: DeleteChatResponse = cli.im.v1.chat.delete(request)
+    response: DeleteChatResponse = ratelimit.call(
+        "chat.delete", chat_id, lambda: cli.im.v1.chat.delete(request, client.request_option())
+    )
 
     # Check if the delete chat request was successful
     if not response.success():
@@ -273,9 +360,75 @@ def delete_group(chat_id: str) -> bool:
         )
         return False
 
+    invalidate_group_index()
     return True
 
 
+def get_bot_open_id() -> str:
+    """
+    Retrieves the open ID of this robot, cached. Blocks on a miss, so the
+    event path uses cached_bot_open_id instead.
+
+    Returns:
+        str: The open ID, or '' if it could not be fetched.
+    """
+    def fetch() -> str:
+        request = lark.BaseRequest.builder() \
+            .http_method(lark.HttpMethod.GET) \
+            .uri("/open-apis/bot/v3/info") \
+            .token_types({lark.AccessTokenType.TENANT}) \
+            .build()
+        response = ratelimit.call(
+            "bot.info", None, lambda: __create_client().request(request, client.request_option())
+        )
+        if not response.success():
+            logger.error(
+                f"get bot info failed, code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
+            )
+            return ''
+        return json.loads(response.raw.content).get("bot", {}).get("open_id", '')
+
+    open_id = __bot_info_cache.get("open_id")
+    if open_id is None:
+        try:
+            open_id = fetch()
+        except Exception as e:
+            logger.error(f"get bot info failed: {e}")
+            open_id = ''
+        __bot_info_cache.set("open_id", open_id, None if open_id else BOT_INFO_RETRY)
+    return open_id
+
+
+def resolve_bot_open_id():
+    """ Fetch the open ID of this robot on a background thread, unless a fetch is running """
+    global __bot_info_resolving
+    with __bot_info_lock:
+        if __bot_info_resolving:
+            return
+        __bot_info_resolving = True
+
+    def run():
+        global __bot_info_resolving
+        try:
+            get_bot_open_id()
+        finally:
+            __bot_info_resolving = False
+
+    threading.Thread(target=run, name="bot-info", daemon=True).start()
+
+
+def cached_bot_open_id() -> str:
+    """
+    The open ID of this robot if already known, never blocking: on a miss
+    it is resolved in the background and '' is returned meanwhile.
+    """
+    open_id = __bot_info_cache.get("open_id")
+    if open_id is None:
+        resolve_bot_open_id()
+        return ''
+    return open_id
+
+
 def update_group_name(chat_id: str, chat_name: str) -> bool:
     """
     Update the name of a group chat.
@@ -291,14 +444,12 @@ def update_group_name(chat_id: str, chat_name: str) -> bool:
     cli = __create_client()
 
     # Build the request object
-    request: UpdateChatRequest = UpdateChatRequest.builder() \
-        .chat_id(chat_id) \
-        .user_id_type('user_id') \
-        .request_body(UpdateChatRequestBody.builder()
-                      .name(chat_name).build()).build()
+    request: UpdateChatRequest = update_group_name_request(chat_id, chat_name)
 
     # Send the update request to the client
-    response: UpdateChatResponse = cli.im.v1.chat.update(request)
+    response: UpdateChatResponse = ratelimit.call(
+        "chat.update", chat_id, lambda: cli.im.v1.chat.update(request, client.request_option())
+    )
 
     # Check if the update was successful
     if not response.success():
@@ -308,49 +459,141 @@ def update_group_name(chat_id: str, chat_name: str) -> bool:
         )
         return False
 
+    invalidate_group_index()
     return True
 
 
+def __paginate(fetch_page, what: str) -> Iterator:
+    """
+    Yields items page by page. The next page is fetched in the background
+    while the caller consumes the current one. Retries are left to the rate
+    limiter fetch_page calls through, so a page it gives up on fails at once.
+
+    Args:
+        fetch_page: Function of a page token (None for the first page) returning the API response.
+        what (str): Name of the call for logging.
+
+    Raises:
+        PageError: A page failed.
+    """
+    def fetch(page_token):
+        try:
+            response = fetch_page(page_token)
+        except Exception as e:
+            logger.error(f"{what} failed: {e}")
+            raise PageError(f"{what} failed: {e}") from e
+        if not response.success():
+            logger.error(f"{what} failed: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}")
+            raise PageError(f"{what} failed, code: {response.code}, msg: {response.msg}")
+        return response
+
+    future = __prefetch_executor.submit(fetch, None)
+    while future is not None:
+        response = future.result()
+        future = None
+        if response.data.has_more and response.data.page_token:
+            future = __prefetch_executor.submit(fetch, response.data.page_token)
+        yield from response.data.items or []
+
+
+def group_list_request(page_token: str = None, page_size: int = PAGE_SIZE) -> ListChatRequest:
+    """ One page of the group chats which robot in, shared with utils.arobot """
+    builder = ListChatRequest.builder() \
+        .user_id_type('user_id') \
+        .sort_type('ByCreateTimeAsc') \
+        .page_size(page_size)
+    if page_token:
+        builder.page_token(page_token)
+    return builder.build()
+
+
+def iter_group_list(page_size: int = PAGE_SIZE) -> Iterator[ListChat]:
+    """
+    Iterates over the group chats which robot in.
+
+    Args:
+        page_size (int): Number of groups fetched per request.
+
+    Returns:
+        An iterator of group chat items.
+    """
+    cli = __create_client()
+
+    def fetch_page(page_token):
+        request = group_list_request(page_token, page_size)
+        return ratelimit.call("chat.list", None, lambda: cli.im.v1.chat.list(request, client.request_option()))
+
+    return __paginate(fetch_page, "get group list")
+
+
 def get_group_list() -> List[ListChat]:
     """
     Retrieves the list of group chats which robot in.
     Returns:
         A list of group chat items.
+
     Raises:
-        Exception: If there is an error retrieving the group chat list.
+        PageError: A page failed.
     """
-    cli = __create_client()
+    return list(iter_group_list())
 
-    request: ListChatRequest = ListChatRequest.builder() \
-        .user_id_type('user_id') \
-        .sort_type('ByCreateTimeAsc') \
-        .build()
 
-    response: ListChatResponse = cli.im.v1.chat.list(request)
-    if not response.success():
-        logger.error(
-            f"get group list failed:: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
-        )
-        return []
-
-    group_list = response.data.items
-    while response.data.has_more:
-        request: ListChatRequest = (
-            ListChatRequest.builder()
-            .user_id_type('user_id')
-            .sort_type('ByCreateTimeAsc')
-            .page_token(response.data.page_token)
-            .build()
+def group_members_request(chat_id: str, page_token: str = None, page_size: int = PAGE_SIZE) -> GetChatMembersRequest:
+    """ One page of the members of a group chat, keyed by user ID, shared with utils.arobot """
+    builder = GetChatMembersRequest.builder() \
+        .chat_id(chat_id) \
+        .member_id_type('user_id') \
+        .page_size(page_size)
+    if page_token:
+        builder.page_token(page_token)
+    return builder.build()
+
+
+def iter_group_members(chat_id: str, page_size: int = PAGE_SIZE) -> Iterator[ListMember]:
+    """
+    Iterates over the members in a group chat.
+
+    Args:
+        chat_id (str): The ID of the group chat.
+        page_size (int): Number of members fetched per request.
+
+    Returns:
+        An iterator of members in the group chat.
+    """
+    cli = __create_client()
+
+    def fetch_page(page_token):
+        request = group_members_request(chat_id, page_token, page_size)
+        return ratelimit.call(
+            "chat_members.get", chat_id, lambda: cli.im.v1.chat_members.get(request, client.request_option())
         )
 
-        response: ListChatResponse = cli.im.v1.chat.list(request)
-        if not response.success():
-            logger.error(
-                f"get group list failed: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
-            )
-            return []
-        group_list.extend(response.data.items)
-    return group_list
+    return __paginate(fetch_page, "get group members")
+
+
+def get_group_index() -> List[Tuple[str, str]]:
+    """
+    Returns (name, chat_id) of every group the robot is in, cached for
+    GROUP_INDEX_TTL seconds and dropped when the robot changes a group.
+
+    Raises:
+        PageError: A page failed; nothing is cached, so the next call fetches again.
+    """
+    def load():
+        # the whole list is built before it is cached, a failed page raises first
+        return [(group.name or "", group.chat_id or "") for group in list(iter_group_list())]
+
+    return __group_index_cache.get_or_load("groups", load)
+
+
+def cached_group_index() -> Optional[List[Tuple[str, str]]]:
+    """ The group index if cached, None instead of fetching it; for callers with a deadline """
+    return __group_index_cache.get("groups")
+
+
+def invalidate_group_index():
+    """ Drop the cached group index, e.g. after the robot joined or left a group """
+    __group_index_cache.invalidate("groups")
 
 
 def get_group_members(chat_id: str) -> List[ListMember]:
@@ -362,36 +605,37 @@ def get_group_members(chat_id: str) -> List[ListMember]:
 
     Returns:
         List[ChatMember]: A list of members in the group chat.
+
+    Raises:
+        PageError: A page failed.
     """
-    cli = __create_client()
+    return list(iter_group_members(chat_id))
 
-    request: GetChatMembersRequest = GetChatMembersRequest.builder() \
-        .chat_id(chat_id) \
-        .build()
 
-    response: GetChatMembersResponse = cli.im.v1.chat_members.get(request)
-    if not response.success():
-        logger.error(
-            f"get group members failed: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
-        )
-        return []
-
-    group_members = response.data.items
-    while response.data.has_more:
-        request: GetChatMembersRequest = (
-            GetChatMembersRequest.builder()
-            .chat_id(chat_id)
-            .page_token(response.data.page_token)
-            .build()
-        )
-        response: GetChatMembersResponse = cli.im.v1.chat_members.get(request)
-        if not response.success():
-            logger.error(
-                f"get group members failed: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
-            )
-            return []
-        group_members.extend(response.data.items)
-    return response.data.items
+def get_group_member_index(chat_id: str) -> Dict[str, ListMember]:
+    """
+    Returns the members of a group chat keyed by user ID, served from the
+    member cache and fetched once per MEMBER_CACHE_TTL seconds.
+
+    Args:
+        chat_id (str): The ID of the group chat.
+
+    Returns:
+        Dict[str, ListMember]: The members keyed by member_id, empty and
+        not cached if a page failed.
+    """
+    try:
+        return __member_cache.get_or_load(
+            chat_id, lambda: {member.member_id: member for member in iter_group_members(chat_id)} or None
+        ) or {}
+    except PageError as e:
+        logger.error(f"member index of {chat_id} failed: {e}")
+        return {}
+
+
+def invalidate_group_members(chat_id: str):
+    """ Drop the cached members of a group chat, e.g. after members joined or left """
+    __member_cache.invalidate(chat_id)
 
 
 def get_group_member_name(chat_id: str, user_id: str) -> str:
@@ -405,55 +649,55 @@ def get_group_member_name(chat_id: str, user_id: str) -> str:
     Returns:
         str: The name of the member.
     """
-    members: List[ListMember] = get_group_members(chat_id)
-    for member in members:
-        if member.member_id == user_id:
-            return member.name
-    return ''
+    member = get_group_member_index(chat_id).get(user_id)
+    return member.name if member is not None else ''
 
 
-def get_chat_history(chat_id: str) -> List[Message]:
+def chat_history_request(chat_id: str, page_token: str = None, page_size: int = PAGE_SIZE) -> ListMessageRequest:
+    """ One page of the messages of a chat, oldest first, shared with utils.arobot """
+    builder = ListMessageRequest.builder() \
+        .container_id_type("chat") \
+        .container_id(chat_id) \
+        .sort_type('ByCreateTimeAsc') \
+        .page_size(page_size)
+    if page_token:
+        builder.page_token(page_token)
+    return builder.build()
+
+
+def iter_chat_history(chat_id: str, page_size: int = PAGE_SIZE) -> Iterator[Message]:
     """
-    Retrieves the history of messages in a group chat.
+    Iterates over the history of messages in a group chat, oldest first.
 
     Args:
         chat_id (str): The ID of the group chat.
+        page_size (int): Number of messages fetched per request.
 
     Returns:
-        List[Message]: A list of messages in the group chat.
+        An iterator of messages in the group chat.
     """
     cli = __create_client()
 
-    request: ListMessageRequest = ListMessageRequest.builder() \
-        .container_id_type("chat") \
-        .container_id(chat_id) \
-        .sort_type('ByCreateTimeAsc') \
-        .build()
-
-    response: ListMessageResponse = cli.im.v1.message.list(request)
-    if not response.success():
-        logger.error(
-            f"get chat history failed: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
-        )
-        return []
-
-    message_list = response.data.items
-    while response.data.has_more:
-        request: ListMessageRequest = (
-            ListMessageRequest.builder()
-            .container_id_type("chat")
-            .container_id(chat_id)
-            .sort_type('ByCreateTimeAsc')
-            .page_token(response.data.page_token)
-            .build()
+    def fetch_page(page_token):
+        request = chat_history_request(chat_id, page_token, page_size)
+        return ratelimit.call(
+            "message.list", chat_id, lambda: cli.im.v1.message.list(request, client.request_option())
         )
 
-        response: ListMessageResponse = cli.im.v1.message.list(request)
-        if not response.success():
-            logger.error(
-                f"get chat history failed: code: {response.code}, msg: {response.msg}, log_id: {response.get_log_id()}"
-            )
-            return []
-        message_list.extend(response.data.items)
+    return __paginate(fetch_page, "get chat history")
+
 
-    return message_list
+def get_chat_history(chat_id: str) -> List[Message]:
+    """
+    Retrieves the history of messages in a group chat.
+
+    Args:
+        chat_id (str): The ID of the group chat.
+
+    Returns:
+        List[Message]: A list of messages in the group chat.
+
+    Raises:
+        PageError: A page failed.
+    """
+    return list(iter_chat_history(chat_id))
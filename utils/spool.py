@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    write-ahead event spool
+
+    /event only verifies a request and appends the decrypted event to a
+    SQLite journal, then acks, so ack latency does not depend on downstream
+    load. A consumer pool drains the journal: an event is checkpointed once
+    its handler, and the lane tasks it queued, have run. Claiming stops
+    while the lanes are full, and an event whose task a lane shed anyway is
+    handed out again rather than checkpointed. Leases of held events are
+    renewed, and events of a crashed process are claimed again after
+    restart, so delivery is at least once.
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Set
+
+from lark_oapi import logger
+from lark_oapi.core.model import RawRequest, RawResponse
+
+import utils.lanes as lanes
+
+# Consumer threads per process, events claimed per poll, and events held at once
+# (an event stays held until the lane tasks it queued have run; kept below the
+# smallest lane depth so the spool alone cannot fill a lane)
+SPOOL_WORKERS = 4
+SPOOL_BATCH = 32
+SPOOL_MAX_IN_FLIGHT = 48
+# Lanes the handlers of spooled events queue on, claiming waits for room in all of them
+SPOOL_LANES = (lanes.FAST, lanes.CHAT, lanes.ORDER)
+# Seconds a claimed event is held before another consumer may take it over,
+# and between renewals of the leases this process still holds
+SPOOL_LEASE = 300.0
+SPOOL_RENEW_INTERVAL = SPOOL_LEASE / 3
+# Seconds before an event whose task a lane shed is handed out again
+SPOOL_REQUEUE_DELAY = 5.0
+# Claims of one event before it is given up and left in the journal
+SPOOL_MAX_ATTEMPTS = 5
+# Seconds between polls when the spool looks empty, and between checkpoints
+SPOOL_POLL_INTERVAL = 0.5
+# Processed events are kept this many seconds, then purged
+SPOOL_RETENTION = 24 * 3600
+SPOOL_PURGE_INTERVAL = 600
+
+_current = threading.local()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Entry:
+    """ One claimed event; checkpointed when its last hold is released, or handed out again if a task was shed """
+
+    def __init__(self, spool: "Spool", event_id: int):
+        self.spool = spool
+        self.event_id = event_id
+        self.holds = 1
+        self.shed = False
+        self._lock = threading.Lock()
+
+    def hold(self):
+        with self._lock:
+            self.holds += 1
+
+    def release(self):
+        with self._lock:
+            self.holds -= 1
+            done = self.holds == 0
+        if done and self.shed:
+            self.spool.requeue(self.event_id)
+        elif done:
+            self.spool.ack(self.event_id)
+
+
+def consuming() -> bool:
+    """ True while the current thread runs a handler for a spooled event """
+    return getattr(_current, "entry", None) is not None
+
+
+def submit(lane: str, fn: Callable, *args) -> bool:
+    """
+    Queue fn(*args) on a lane, see lanes.submit. Inside a spool consumer the
+    event is only checkpointed once fn has run; if the lane sheds fn, the
+    event is not checkpointed but handed out again.
+    """
+    entry: Optional[_Entry] = getattr(_current, "entry", None)
+    if entry is None:
+        return lanes.submit(lane, fn, *args)
+    entry.hold()
+
+    def run(*run_args):
+        try:
+            return fn(*run_args)
+        finally:
+            entry.release()
+
+    run.__name__ = getattr(fn, "__name__", "run")
+    if not lanes.submit(lane, run, *args):
+        entry.shed = True
+        entry.release()
+        return False
+    return True
+
+
+def verify(handler, req: RawRequest):
+    """
+    Decrypt and authenticate an event request the way the Lark event handler does.
+
+    Args:
+        handler: The lark.EventDispatcherHandler holding the keys.
+        req (RawRequest): The request.
+
+    Returns:
+        Tuple[Optional[dict], Optional[RawResponse]]: The event and no response,
+        or no event and the response to send (challenge or error).
+    """
+    resp = RawResponse()
+    resp.status_code = 200
+    resp.set_content_type("application/json; charset=utf-8")
+    try:
+        if req.body is None:
+            raise ValueError("request body is null")
+        plaintext = handler._decrypt(req.body)
+        body = json.loads(plaintext)
+        token = body["header"].get("token") if body.get("schema") else body.get("token")
+        if token is not None and token != handler._verification_token:
+            raise PermissionError("invalid verification_token")
+        if body.get("type") == "url_verification":
+            resp.content = json.dumps({"challenge": body.get("challenge")}).encode()
+            return None, resp
+        handler._verify_sign(req)
+        return {"plaintext": plaintext, "body": body}, None
+    except Exception as e:
+        logger.error(f"event rejected: {e}")
+        resp.status_code = 500
+        resp.content = json.dumps({"msg": str(e)}).encode()
+        return None, resp
+
+
+class Spool:
+    def __init__(self, consume: Callable[[bytes], None], workers: int = SPOOL_WORKERS):
+        """
+        Args:
+            consume (Callable[[bytes], None]): Handles one event payload,
+                e.g. lark.EventDispatcherHandler.do_without_validation.
+            workers (int): Consumer threads.
+        """
+        self.consume = consume
+        self.workers = workers
+        self.appended = 0
+        self.duplicates = 0
+        self.consumed = 0
+        self.failed = 0
+        self.requeued = 0
+        self._acks: List[int] = []
+        self._requeues: List[int] = []
+        # events claimed and not yet acked, requeued or failed
+        self._held: Set[int] = set()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+        self._started = False
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    def ingest(self, handler, req: RawRequest) -> RawResponse:
+        """ Verify an /event request, append it to the journal and ack """
+        import store.db_spool as db_spool
+        event, resp = verify(handler, req)
+        if event is None:
+            return resp
+        body = event["body"]
+        event_id = body["header"].get("event_id") if body.get("schema") else body.get("uuid")
+        if db_spool.append_event(event_id, event["plaintext"]):
+            self.appended += 1
+            with self._cond:
+                self._cond.notify()
+        else:
+            self.duplicates += 1
+        resp = RawResponse()
+        resp.status_code = 200
+        resp.set_content_type("application/json; charset=utf-8")
+        resp.content = b'{"msg":"success"}'
+        return resp
+
+    def start(self):
+        """ Release the claims of dead processes, then start draining the journal """
+        import store.db_spool as db_spool
+        if self._started:
+            return
+        self._started = True
+        dead = [pid for pid in db_spool.select_claim_owners() if pid != os.getpid() and not _alive(pid)]
+        released = db_spool.release_claims(dead)
+        if released:
+            logger.info(f"spool: replaying {released} events of dead processes {dead}")
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="spool")
+        threading.Thread(target=self._poll, name="spool-poll", daemon=True).start()
+
+    def ack(self, event_id: int):
+        with self._cond:
+            self._acks.append(event_id)
+            self._held.discard(event_id)
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def requeue(self, event_id: int):
+        """ Hand a held event out again, e.g. when a lane shed one of its tasks """
+        with self._cond:
+            self.requeued += 1
+            self._requeues.append(event_id)
+            self._held.discard(event_id)
+            self._in_flight -= 1
+            self._cond.notify()
+
+    def _run(self, event_id: int, payload: str):
+        entry = _Entry(self, event_id)
+        _current.entry = entry
+        try:
+            self.consume(payload.encode())
+            self.consumed += 1
+        except Exception as e:
+            # not checkpointed nor renewed: claimed again once its lease expires
+            self.failed += 1
+            logger.error(f"spool: event {event_id} failed: {e}")
+            with self._cond:
+                self._held.discard(event_id)
+                self._in_flight -= 1
+            return
+        finally:
+            _current.entry = None
+        entry.release()
+
+    @staticmethod
+    def _lane_room() -> int:
+        """ Tasks the spooled events' lanes can all take without waiting """
+        return min(lanes.get_lane(name).room() for name in SPOOL_LANES)
+
+    def _poll(self):
+        import store.db_spool as db_spool
+        owner = os.getpid()
+        next_purge = time.monotonic() + SPOOL_PURGE_INTERVAL
+        next_renew = time.monotonic() + SPOOL_RENEW_INTERVAL
+        while True:
+            with self._cond:
+                acks, self._acks = self._acks, []
+                requeues, self._requeues = self._requeues, []
+                held = set(self._held)
+                # backpressure: claim no more than the lanes can queue right now
+                room = min(SPOOL_MAX_IN_FLIGHT - self._in_flight, self._lane_room())
+            try:
+                db_spool.checkpoint_events(acks)
+                acks = []
+                db_spool.requeue_events(requeues, SPOOL_REQUEUE_DELAY)
+                requeues = []
+                if time.monotonic() > next_renew:
+                    next_renew = time.monotonic() + SPOOL_RENEW_INTERVAL
+                    db_spool.renew_claims(owner, list(held), SPOOL_LEASE)
+                events = db_spool.claim_events(owner, min(room, SPOOL_BATCH), SPOOL_LEASE, SPOOL_MAX_ATTEMPTS,
+                                               held) if room > 0 else []
+                if time.monotonic() > next_purge:
+                    next_purge = time.monotonic() + SPOOL_PURGE_INTERVAL
+                    db_spool.delete_done_events(time.time() - SPOOL_RETENTION)
+            except Exception as e:
+                logger.error(f"spool: journal failed: {e}")
+                with self._cond:
+                    self._acks = acks + self._acks
+                    self._requeues = requeues + self._requeues
+                time.sleep(SPOOL_POLL_INTERVAL)
+                continue
+            with self._cond:
+                self._in_flight += len(events)
+                self._held.update(event_id for event_id, _ in events)
+            for event_id, payload in events:
+                self._pool.submit(self._run, event_id, payload)
+            if len(events) < SPOOL_BATCH:
+                with self._cond:
+                    self._cond.wait(SPOOL_POLL_INTERVAL)
+
+    def stats(self) -> dict:
+        import store.db_spool as db_spool
+        stats = {
+            "appended": self.appended, "duplicates": self.duplicates, "consumed": self.consumed,
+            "failed": self.failed, "requeued": self.requeued, "in_flight": self._in_flight,
+        }
+        try:
+            stats.update(db_spool.count_events(SPOOL_MAX_ATTEMPTS))
+        except Exception as e:
+            logger.error(f"spool: journal failed: {e}")
+        return stats
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    token counting for chat messages
+
+    Uses tiktoken when it is installed, otherwise a character based estimate
+    that errs on the high side, so budgets are never overrun.
+"""
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Tokens every chat message costs on top of its content (role and separators)
+MESSAGE_OVERHEAD = 4
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """ Tokens of a text """
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text))
+    # ~4 chars per token for latin text, but a CJK char is about one token
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def count_message_tokens(content: str, model: str = "gpt-3.5-turbo") -> int:
+    """ Tokens a chat message with this content costs, always at least MESSAGE_OVERHEAD """
+    return MESSAGE_OVERHEAD + count_tokens(content, model)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+    pooled transport for lark_oapi
+
+    lark_oapi's Transport.execute calls requests.request for every call, and
+    Transport.aexecute opens a new httpx.AsyncClient for every call, so each
+    api call pays a new TCP and TLS handshake. install() swaps them for the
+    same requests over one shared requests.Session and one httpx.AsyncClient
+    per event loop, which keep connections alive. The async client speaks
+    HTTP/2 when the optional h2 package is installed.
+"""
+import asyncio
+import json
+import threading
+from typing import Dict
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+
+from lark_oapi.core.const import UTF_8
+from lark_oapi.core.http import Transport
+from lark_oapi.core.http.transport import _build_url, _build_header
+from lark_oapi.core.json import JSON
+from lark_oapi.core.model import Config, BaseRequest, RawResponse, RequestOption
+
+# Connections kept alive per host, sized for the lane workers and the limiter's concurrency
+POOL_CONNECTIONS = 64
+
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=POOL_CONNECTIONS))
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=POOL_CONNECTIONS))
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+_async_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
+_installed = False
+_install_lock = threading.Lock()
+
+
+def _execute(conf: Config, req: BaseRequest, option: RequestOption = None) -> RawResponse:
+    """ Transport.execute of lark_oapi, over the shared session """
+    if option is None:
+        option = RequestOption()
+    url = _build_url(conf.domain, req.uri, req.paths)
+    _build_header(req, option)
+    data = req.body
+    if data is not None and not isinstance(data, MultipartEncoder):
+        data = JSON.marshal(req.body).encode(UTF_8)
+
+    response = _session.request(
+        str(req.http_method.name),
+        url,
+        headers=req.headers,
+        params=req.queries,
+        data=data,
+        timeout=conf.timeout,
+    )
+
+    resp = RawResponse()
+    resp.status_code = response.status_code
+    resp.headers = dict(response.headers)
+    resp.content = response.content
+    return resp
+
+
+def _async_client() -> httpx.AsyncClient:
+    """ The shared async client of the running loop; an httpx client cannot move between loops """
+    loop = asyncio.get_running_loop()
+    cli = _async_clients.get(loop)
+    if cli is None:
+        limits = httpx.Limits(max_connections=POOL_CONNECTIONS, max_keepalive_connections=POOL_CONNECTIONS)
+        cli = _async_clients[loop] = httpx.AsyncClient(http2=HTTP2, limits=limits)
+    return cli
+
+
+async def _aexecute(conf: Config, req: BaseRequest, option: RequestOption = None) -> RawResponse:
+    """ Transport.aexecute of lark_oapi, over the loop's shared async client """
+    if option is None:
+        option = RequestOption()
+    url = _build_url(conf.domain, req.uri, req.paths)
+    _build_header(req, option)
+    json_, files, data = None, None, None
+    if req.files:
+        files = req.files
+        if req.body is not None:
+            data = json.loads(JSON.marshal(req.body))
+    elif req.body is not None:
+        json_ = json.loads(JSON.marshal(req.body))
+
+    response = await _async_client().request(
+        str(req.http_method.name),
+        url,
+        headers=req.headers,
+        params=req.queries,
+        json=json_,
+        data=data,
+        files=files,
+        timeout=conf.timeout,
+    )
+
+    resp = RawResponse()
+    resp.status_code = response.status_code
+    resp.headers = dict(response.headers)
+    resp.content = response.content
+    return resp
+
+
+def install():
+    """ Route every lark_oapi call of this process through the pooled transport; idempotent """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        Transport.execute = staticmethod(_execute)
+        Transport.aexecute = staticmethod(_aexecute)
+        _installed = True